@@ -0,0 +1,159 @@
+import logging
+import time
+
+from twscrape import AccountsPool
+
+from constants import AccountPoolConstants
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(Exception):
+    def __init__(self, queue, open_until):
+        super().__init__(f"No account available for queue '{queue}', "
+                         f"circuit open for {max(0, int(open_until - time.time()))}s")
+        self.queue = queue
+        self.open_until = open_until
+
+
+class AccountHealth:
+    __slots__ = ('requests', 'errors', 'error_rate', 'latency', 'budgets')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.error_rate = 0.0
+        self.latency = None
+        # queue -> (remaining, limit, reset_at) from the x-rate-limit-* headers of the last response
+        self.budgets = {}
+
+    def record_response(self, queue, status_code, latency, headers):
+        smoothing = AccountPoolConstants.HEALTH_SMOOTHING
+        is_error = status_code >= 400
+        self.requests += 1
+        self.errors += is_error
+        self.error_rate += smoothing * (is_error - self.error_rate)
+        self.latency = latency if self.latency is None else self.latency + smoothing * (latency - self.latency)
+
+        remaining, limit, reset_at = (headers.get(f'x-rate-limit-{name}') for name in ('remaining', 'limit', 'reset'))
+        if remaining is not None and limit is not None and reset_at is not None:
+            self.budgets[queue] = (int(remaining), int(limit), int(reset_at))
+
+    def get_budget(self, queue, now):
+        # (remaining, limit), or None while unknown or after the rate limit window has reset
+        budget = self.budgets.get(queue)
+        if budget is None or budget[2] <= now:
+            return None
+        return budget[0], budget[1]
+
+    def score(self, queue, now):
+        budget = self.get_budget(queue, now)
+        budget_left = budget[0] / budget[1] if budget and budget[1] > 0 else 1.0
+        return budget_left * (1 - self.error_rate) / (1 + (self.latency or 0))
+
+
+class HealthAwareAccountsPool(AccountsPool):
+    # Tracks the request budget, error rate and latency of every account from the responses it gets, hands out the
+    # healthiest unlocked account first, and opens a circuit breaker for a queue when all the accounts are locked
+    # instead of waiting on the pool like twscrape does.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health = {}
+        self.circuit_open_until = {}
+
+    def get_health(self, username):
+        health = self.health.get(username)
+        if health is None:
+            health = self.health[username] = AccountHealth()
+        return health
+
+    def _get_order_by(self, queue):
+        # twscrape picks the account with ORDER BY _order_by, so the ranking is passed as a CASE over the usernames
+        now = time.time()
+        ranking = sorted(self.health, key=lambda username: self.health[username].score(queue, now), reverse=True)
+        if not ranking:
+            return AccountsPool._order_by
+        cases = ' '.join(f"WHEN '{username.replace(chr(39), chr(39) * 2)}' THEN {position}"
+                         for position, username in enumerate(ranking))
+        # Accounts without responses yet haven't shown any problem, so they go first
+        return f"CASE username {cases} ELSE -1 END, {AccountsPool._order_by}"
+
+    async def get_for_queue(self, queue):
+        # The query is built before the first await, so concurrent callers can't see each other's ranking
+        self._order_by = self._get_order_by(queue)
+        account = await super().get_for_queue(queue)
+        if account is not None:
+            self._track_requests(account, queue)
+        return account
+
+    async def get_for_queue_or_wait(self, queue):
+        open_until = self.circuit_open_until.get(queue, 0)
+        if time.time() < open_until:
+            raise PoolExhaustedError(queue, open_until)
+
+        account = await self.get_for_queue(queue)
+        if account is None:
+            open_until = await self._get_circuit_open_until(queue)
+            self.circuit_open_until[queue] = open_until
+            logger.warning(f"All accounts are locked for queue '{queue}', "
+                           f"pausing it until {time.strftime('%H:%M:%S', time.localtime(open_until))}")
+            raise PoolExhaustedError(queue, open_until)
+
+        self.circuit_open_until.pop(queue, None)
+        return account
+
+    async def _get_circuit_open_until(self, queue):
+        now = time.time()
+        unlock_times = [account.locks[queue].timestamp() for account in await self.get_all()
+                        if account.active and queue in account.locks]
+        open_for = min(unlock_times) - now if unlock_times else AccountPoolConstants.CIRCUIT_BREAKER_MAX_OPEN
+        return now + min(max(open_for, AccountPoolConstants.CIRCUIT_BREAKER_MIN_OPEN),
+                         AccountPoolConstants.CIRCUIT_BREAKER_MAX_OPEN)
+
+    def is_circuit_open(self, queue):
+        return time.time() < self.circuit_open_until.get(queue, 0)
+
+    def _track_requests(self, account, queue):
+        health = self.get_health(account.username)
+        make_client = account.make_client
+
+        async def on_request(request):
+            request.extensions['started_at'] = time.monotonic()
+
+        async def on_response(response):
+            latency = time.monotonic() - response.request.extensions.get('started_at', time.monotonic())
+            health.record_response(queue, response.status_code, latency, response.headers)
+
+        def make_tracked_client():
+            client = make_client()
+            client.event_hooks['request'].append(on_request)
+            client.event_hooks['response'].append(on_response)
+            return client
+
+        account.make_client = make_tracked_client
+
+    async def get_status(self, queue=AccountPoolConstants.TIMELINE_QUEUE):
+        # One line per account for the /status command
+        now = time.time()
+        lines = []
+        for account in await self.get_all():
+            health = self.get_health(account.username)
+            locked_until = account.locks.get(queue)
+            budget = health.get_budget(queue, now)
+
+            if not account.active:
+                state = f"inactive ({account.error_msg})" if account.error_msg else 'inactive'
+            elif locked_until is not None and locked_until.timestamp() > now:
+                state = f"locked until {time.strftime('%H:%M:%S', time.localtime(locked_until.timestamp()))}"
+            else:
+                state = 'available'
+            lines.append(f"@{account.username}: {state}, "
+                         f"budget {f'{budget[0]}/{budget[1]}' if budget else 'unknown'}, "
+                         f"{health.requests} requests, error rate {health.error_rate:.0%}, "
+                         f"latency {f'{health.latency:.2f}s' if health.latency is not None else 'unknown'}")
+
+        if self.is_circuit_open(queue):
+            lines.append(f"Circuit open until "
+                         f"{time.strftime('%H:%M:%S', time.localtime(self.circuit_open_until[queue]))}")
+        return lines
@@ -0,0 +1,106 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import httpx
+
+FILLER_WORDS = ['market', 'update', 'breaking', 'shares', 'report', 'says', 'sources', 'expected', 'rate', 'cut',
+                'earnings', 'beat', 'miss', 'guidance', 'trading', 'volume', 'futures', 'session', 'higher', 'lower']
+
+
+class TweetStream:
+    # Synthetic timelines: every call to post_new_tweets adds about tweets_per_cycle tweets per user,
+    # a keyword_density share of them containing one of the keywords
+    def __init__(self, usernames, keywords, tweets_per_cycle, keyword_density, words_per_tweet=20, seed=0):
+        self.usernames = usernames
+        self.keywords = keywords
+        self.tweets_per_cycle = tweets_per_cycle
+        self.keyword_density = keyword_density
+        self.words_per_tweet = words_per_tweet
+        self.timelines = {username: [] for username in usernames}
+        self.posted_tweets = 0
+        self._random = random.Random(seed)
+        self._next_tweet_id = 1_000_000
+
+    def _make_message(self):
+        words = self._random.choices(FILLER_WORDS, k=self.words_per_tweet)
+        if self._random.random() < self.keyword_density:
+            words.insert(self._random.randrange(len(words)), self._random.choice(self.keywords))
+        return ' '.join(words)
+
+    def post_new_tweets(self):
+        now = datetime.now(timezone.utc)
+        for username in self.usernames:
+            # Poisson-like: the number of tweets varies around the configured rate
+            count = sum(1 for _ in range(self.tweets_per_cycle * 2) if self._random.random() < 0.5)
+            for _ in range(count):
+                self._next_tweet_id += 1
+                self.timelines[username].append(SimpleNamespace(
+                    id=self._next_tweet_id, date=now, rawContent=self._make_message(),
+                    user=SimpleNamespace(username=username)))
+            self.posted_tweets += count
+
+
+class FakeAccountsPool:
+    def __init__(self, accounts=3):
+        self._accounts = [SimpleNamespace(username=f'account{i}', active=True) for i in range(accounts)]
+
+    async def get_all(self):
+        return self._accounts
+
+    def is_circuit_open(self, queue):
+        return False
+
+
+class FakeTwitterAPI:
+    # The part of twscrape.API used by TwitterScraper, answering from a TweetStream with a simulated network latency
+    def __init__(self, stream, latency=0.05, accounts=3):
+        self.stream = stream
+        self.latency = latency
+        self.pool = FakeAccountsPool(accounts)
+        self._user_ids = {username: i for i, username in enumerate(stream.usernames, start=1)}
+        self._usernames = {i: username for username, i in self._user_ids.items()}
+
+    async def user_by_login(self, username):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(id=self._user_ids[username], username=username)
+
+    async def user_tweets(self, uid, limit=-1):
+        # Newest first, one simulated request per page of 20 tweets
+        timeline = self.stream.timelines[self._usernames[uid]]
+        for i, tweet in enumerate(reversed(timeline)):
+            if i % 20 == 0:
+                await asyncio.sleep(self.latency)
+            if 0 < limit <= i:
+                return
+            yield tweet
+
+
+class FakeBot:
+    # Records what the bot would have sent to Telegram
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.sent_messages = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent_messages += 1
+
+
+class FakeJobQueue:
+    def __init__(self, application):
+        self.application = application
+
+    def get_jobs_by_name(self, name):
+        return []
+
+    def run_once(self, callback, when, name=None):
+        # The benchmark drives the cycles itself
+        pass
+
+
+def make_image_search_client(images=20):
+    # In-process transport for ImageResolver that answers every search with the same result page
+    page = ''.join(f'<img src="/images/{i}.jpg">' for i in range(images)).encode()
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=page)))
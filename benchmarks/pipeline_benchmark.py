@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import time as time_of_day
+from types import SimpleNamespace
+
+import x_to_telegram_bot
+from benchmarks.fakes import FakeBot, FakeJobQueue, FakeTwitterAPI, TweetStream, make_image_search_client
+from bot_data_processor import BotDataProcessor
+from constants import DeliveryConstants
+from db.database_controller import DatabaseController
+from google.image_resolver import ImageResolver
+from pipeline import TweetPipeline
+from scheduler import AdaptivePollingInterval, Scheduler, TimeWindow
+from telegram_delivery import DeliveryEngine
+from twitter_scraper import TwitterScraper
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the poll -> scrape -> store -> send pipeline offline, against '
+                                                 'a fake twscrape API and a fake Telegram bot.')
+    parser.add_argument('--users', type=int, default=10, help='monitored twitter users')
+    parser.add_argument('--chats', type=int, default=20, help='subscribed chats, half groups and half private')
+    parser.add_argument('--cycles', type=int, default=20, help='measured poll cycles')
+    parser.add_argument('--tweets-per-cycle', type=int, default=5, help='average new tweets per user per cycle')
+    parser.add_argument('--keyword-density', type=float, default=0.2, help='share of tweets with a keyword')
+    parser.add_argument('--keywords', type=int, default=50, help='number of distinct keywords')
+    parser.add_argument('--keywords-per-chat', type=int, default=10)
+    parser.add_argument('--twitter-latency', type=float, default=0.05, help='seconds per fake twscrape request')
+    parser.add_argument('--send-latency', type=float, default=0.02, help='seconds per fake Telegram send')
+    parser.add_argument('--digest-window', type=int, default=0, help='digest window of every chat in seconds, '
+                                                                     '0 sends every message on its own')
+    parser.add_argument('--unthrottled', action='store_true',
+                        help="disable the Telegram flood limits, so the numbers show the bot's own overhead")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also report the peak of the Python allocations (tracemalloc, slows the run down)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--max-p95', type=float, help='exit with 1 when the p95 cycle latency is above this, in s')
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values, ratio):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+
+def _count_stored_tweets(conn):
+    return conn.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+
+
+async def run_benchmark(args):
+    rng = random.Random(args.seed)
+    usernames = [f'user{i}' for i in range(args.users)]
+    keywords = [f'$T{i:03d}' for i in range(args.keywords)]
+    stream = TweetStream(usernames, keywords, args.tweets_per_cycle, args.keyword_density, seed=args.seed)
+
+    controller = DatabaseController()
+    processor = BotDataProcessor(controller)
+    processor.set_monitored_users([f'@{username}' for username in usernames])
+    processor.set_filter_keywords(keywords)
+    for i in range(args.chats):
+        chat_id = -1000 - i if i % 2 else 1000 + i
+        processor.add_subscribed_chat_id(chat_id)
+        processor.set_chat_filter_keywords(chat_id, rng.sample(keywords, min(args.keywords_per_chat, len(keywords))))
+        processor.set_chat_digest_window(chat_id, args.digest_window)
+
+    bot = FakeBot(args.send_latency)
+    scraper = TwitterScraper(controller)
+    scraper.api = FakeTwitterAPI(stream, args.twitter_latency)
+    scraper.image_resolver = ImageResolver(client=make_image_search_client())
+
+    delivery_engine = DeliveryEngine(bot)
+    pipeline = TweetPipeline(scraper, processor, delivery_engine)
+    application = SimpleNamespace(bot=bot, injected_bot_data_processor=processor, injected_scraper=scraper,
+                                  injected_delivery_engine=delivery_engine, injected_pipeline=pipeline,
+                                  injected_scraper_workers=None,
+                                  injected_polling_interval=AdaptivePollingInterval())
+    context = SimpleNamespace(application=application, bot=bot, job_queue=FakeJobQueue(application))
+
+    # The first cycle resolves the users and only reads FIRST_FETCH_LIMIT tweets each, so it is not measured
+    pipeline.start()
+    stream.post_new_tweets()
+    await x_to_telegram_bot.send_scheduled_message(context)
+    await pipeline.drain()
+    posted_before, sent_before = stream.posted_tweets, bot.sent_messages
+    stored_before = await controller.engine.read(_count_stored_tweets)
+
+    cycle_latencies = []
+    started_at = time.perf_counter()
+    for _ in range(args.cycles):
+        stream.post_new_tweets()
+        cycle_started_at = time.perf_counter()
+        await x_to_telegram_bot.send_scheduled_message(context)
+        cycle_latencies.append(time.perf_counter() - cycle_started_at)
+    # The cycles only produce, the time until the queued messages are sent counts towards the throughput
+    await pipeline.drain()
+    await pipeline.stop()
+    await delivery_engine.flush_digests()
+    elapsed = time.perf_counter() - started_at
+
+    ingested = await controller.engine.read(_count_stored_tweets) - stored_before
+    await scraper.image_resolver.close()
+    controller.close()
+
+    cycle_latencies.sort()
+    return {
+        'cycles': args.cycles,
+        'cycle_p50': percentile(cycle_latencies, 0.5),
+        'cycle_p95': percentile(cycle_latencies, 0.95),
+        'cycle_p99': percentile(cycle_latencies, 0.99),
+        'cycle_max': cycle_latencies[-1],
+        'tweets_posted': stream.posted_tweets - posted_before,
+        'tweets_ingested': ingested,
+        'messages_sent': bot.sent_messages - sent_before,
+        'tweets_per_second': ingested / elapsed,
+        'messages_per_second': (bot.sent_messages - sent_before) / elapsed,
+    }
+
+
+def print_report(results):
+    print(f"Cycle latency over {results['cycles']} cycles: p50 {results['cycle_p50']:.3f}s, "
+          f"p95 {results['cycle_p95']:.3f}s, p99 {results['cycle_p99']:.3f}s, max {results['cycle_max']:.3f}s")
+    print(f"Tweets: {results['tweets_posted']} posted, {results['tweets_ingested']} ingested "
+          f"({results['tweets_per_second']:.1f}/s)")
+    print(f"Messages: {results['messages_sent']} sent ({results['messages_per_second']:.1f}/s)")
+    print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB")
+    if 'peak_traced_mb' in results:
+        print(f"Peak Python allocations: {results['peak_traced_mb']:.1f} MB")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    x_to_telegram_bot.logger = logging.getLogger('benchmark')
+    x_to_telegram_bot.logger.setLevel(logging.WARNING)
+    # Share at any time of the day
+    Scheduler.time_window = TimeWindow(time_of_day(0, 0, 0), time_of_day(23, 59, 59))
+    if args.unthrottled:
+        DeliveryConstants.GLOBAL_MESSAGES_PER_SECOND = 1_000_000
+        DeliveryConstants.GROUP_MESSAGES_PER_MINUTE = 1_000_000
+        DeliveryConstants.PRIVATE_CHAT_MESSAGES_PER_SECOND = 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Work in an empty directory, so the bot's data files are neither imported nor touched
+        os.chdir(directory)
+        DatabaseController.DB_NAME = os.path.join(directory, 'data', 'benchmark.db')
+        if args.trace_memory:
+            tracemalloc.start()
+        results = asyncio.run(run_benchmark(args))
+        if args.trace_memory:
+            results['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+    if args.max_p95 is not None and results['cycle_p95'] > args.max_p95:
+        print(f"p95 cycle latency {results['cycle_p95']:.3f}s is above {args.max_p95}s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# To use it run from the project directory:
+# python -m benchmarks.pipeline_benchmark --users 20 --chats 50 --tweets-per-cycle 10 --unthrottled
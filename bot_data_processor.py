@@ -1,64 +1,84 @@
-import json
-import os
-
 from constants import BotConstants
+from keyword_matcher import KeywordSubscriptionIndex
 
 
 class BotDataProcessor:
-    def __init__(self, *args, **kwargs):
+    # The state lives in the database; the attributes below are the in-memory read cache.
+    # Every change updates the cache right away and writes only the changed rows behind it.
+
+    def __init__(self, controller, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._load_subscribed_chat_ids()
-        self._load_monitored_user()
-        self._load_filter_keywords()
-
-    def _load_subscribed_chat_ids(self):
-        subscribed_chat_ids = set()
-        try:
-            with open(BotConstants.SUBSCRIBED_CHAT_IDS_FILE, 'r') as file:
-                data = json.load(file)
-                subscribed_chat_ids = set(data.get('chat_ids', []))
-        except FileNotFoundError:
-            pass
-        except Exception:
-            # File was corrupted, clear file
-            os.remove(BotConstants.SUBSCRIBED_CHAT_IDS_FILE)
-        self.subscribed_chat_ids = subscribed_chat_ids
-
-    def _load_monitored_user(self):
-        monitored_user = None
-        try:
-            with open(BotConstants.MONITORED_USER_FILE, 'r') as file:
-                monitored_user = file.read()
-        except FileNotFoundError:
-            pass
-        self.monitored_twitter_user = monitored_user
-
-    def _load_filter_keywords(self):
-        filter_keywords = set()
-        try:
-            with open(BotConstants.FILTER_KEYWORDS_FILE, 'r') as file:
-                filter_keywords = set(line.strip() for line in file)
-        except FileNotFoundError:
-            pass
-        self.filter_keywords = filter_keywords
-
-    def _save_subscribed_chat_ids(self):
-        data = {'chat_ids': list(self.subscribed_chat_ids)}
-        with open(BotConstants.SUBSCRIBED_CHAT_IDS_FILE, 'w') as file:
-            json.dump(data, file)
+        self.controller = controller
+        self._load_state()
+        self._build_keyword_index()
+
+    def _load_state(self):
+        state = self.controller.load_bot_state()
+        self.subscribed_chat_ids = state.subscribed_chat_ids
+        self.monitored_twitter_users = state.monitored_users
+        self.filter_keywords = state.filter_keywords
+        self.chat_filter_keywords = state.chat_filter_keywords
+        self.chat_digest_windows = state.chat_digest_windows
+
+    def _build_keyword_index(self):
+        self.keyword_index = KeywordSubscriptionIndex(case_insensitive=BotConstants.KEYWORDS_CASE_INSENSITIVE,
+                                                      whole_word=BotConstants.KEYWORDS_WHOLE_WORD)
+        for chat_id in self.subscribed_chat_ids:
+            self._index_chat(chat_id)
+
+    def _index_chat(self, chat_id):
+        self.keyword_index.set_chat_keywords(chat_id, self.get_chat_filter_keywords(chat_id))
+
+    @property
+    def keyword_matcher(self):
+        return self.keyword_index.matcher
 
     def add_subscribed_chat_id(self, chat_id):
         self.subscribed_chat_ids.add(chat_id)
-        self._save_subscribed_chat_ids()
+        self._index_chat(chat_id)
+        self.controller.save_subscribed_chat(chat_id, True)
 
     def remove_subscribed_chat_id(self, chat_id):
         self.subscribed_chat_ids.remove(chat_id)
-        self._save_subscribed_chat_ids()
+        self.keyword_index.remove_chat(chat_id)
+        self.controller.save_subscribed_chat(chat_id, False)
 
     def set_filter_keywords(self, keywords):
-        self.filter_keywords = set(keywords)
-        with open(BotConstants.FILTER_KEYWORDS_FILE, 'w') as file:
-            file.write('\n'.join(self.filter_keywords))
+        keywords = set(keywords)
+        if keywords == self.filter_keywords:
+            return
+
+        added, removed = keywords - self.filter_keywords, self.filter_keywords - keywords
+        self.filter_keywords = keywords
+        # Chats without their own keywords follow the bot keywords
+        for chat_id in self.subscribed_chat_ids:
+            if chat_id not in self.chat_filter_keywords:
+                self._index_chat(chat_id)
+        self.controller.save_filter_keywords_changes(added, removed)
+
+    def set_chat_filter_keywords(self, chat_id, keywords):
+        # Empty keywords make the chat follow the bot keywords again
+        if keywords:
+            self.chat_filter_keywords[chat_id] = set(keywords)
+        else:
+            self.chat_filter_keywords.pop(chat_id, None)
+        if chat_id in self.subscribed_chat_ids:
+            self._index_chat(chat_id)
+        self.controller.save_chat_filter_keywords(chat_id, self.chat_filter_keywords.get(chat_id, ()))
+
+    def get_chat_filter_keywords(self, chat_id):
+        return self.chat_filter_keywords.get(chat_id, self.filter_keywords)
+
+    def get_formatted_chat_keywords(self, chat_id):
+        return ','.join([f"'{keyword}'" for keyword in self.get_chat_filter_keywords(chat_id)])
+
+    def set_chat_digest_window(self, chat_id, window):
+        # 0 turns the digest off, the messages are sent one by one again
+        if window:
+            self.chat_digest_windows[chat_id] = window
+        else:
+            self.chat_digest_windows.pop(chat_id, None)
+        self.controller.save_chat_digest_window(chat_id, window)
 
     def get_formatted_keywords(self):
         return ','.join([f"'{keyword}'" for keyword in self.filter_keywords])
@@ -66,12 +86,11 @@ class BotDataProcessor:
     def get_formatted_subscribed_chat_ids(self):
         return ','.join([f"'{keyword}'" for keyword in self.subscribed_chat_ids])
 
-    def set_monitored_user(self, username):
-        self.monitored_twitter_user = username
-        with open(BotConstants.MONITORED_USER_FILE, 'w') as file:
-            file.write(f"{username}")
+    def set_monitored_users(self, usernames):
+        usernames = set(usernames)
+        added, removed = usernames - self.monitored_twitter_users, self.monitored_twitter_users - usernames
+        self.monitored_twitter_users = usernames
+        self.controller.save_monitored_users_changes(added, removed)
 
-    def get_formatted_monitored_username(self):
-        if self.monitored_twitter_user is None:
-            return None
-        return self.monitored_twitter_user[1:]
+    def get_formatted_monitored_usernames(self):
+        return sorted(username[1:] for username in self.monitored_twitter_users)
@@ -4,20 +4,132 @@ import os
 
 class ScraperConstants:
     MONITORED_USER_DATA_FILE = "data/user_data.txt"
+    FIRST_FETCH_LIMIT = 10
+    MAX_NEW_TWEETS_PER_FETCH = 400
+    # The timeline can start with an old pinned tweet, so stop only after this many already stored tweets in a row
+    KNOWN_TWEETS_BEFORE_STOP = 2
+    CONCURRENT_FETCHES_PER_ACCOUNT = 1
+    USER_ID_CACHE_TTL = 7 * 24 * 60 * 60
+    RESOLVE_USER_ATTEMPTS = 5
+    RESOLVE_USER_RETRY_DELAY = 1
 
 
 class BotConstants:
     BOT_NAME = os.getenv("BOT_NAME")
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     AUTOMATIC_POLL_AND_MSG_JOB_NAME = "Poll twitter and send messsage"
+    DATABASE_MAINTENANCE_JOB_NAME = "Database maintenance"
 
     SUBSCRIBED_CHAT_IDS_FILE = 'data/subscribed_chat_ids.json'
     MONITORED_USER_FILE = 'data/monitored_user.txt'
     FILTER_KEYWORDS_FILE = 'data/filter_keywords.txt'
+    CHAT_FILTER_KEYWORDS_FILE = 'data/chat_filter_keywords.json'
     IMPORTANT_LOG_MARKER = '#IMPORTANT_LOG'
+    KEYWORDS_CASE_INSENSITIVE = False
+    KEYWORDS_WHOLE_WORD = True
     DATABASE_PATH = 'data/database.db'
 
 
+class DatabaseConstants:
+    READ_POOL_SIZE = 3
+    BUSY_TIMEOUT = 10
+    STATEMENT_CACHE_SIZE = 64
+    # Truncate the WAL back to this size after checkpoints
+    JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+    RETENTION_DAYS = 30
+    ARCHIVE_PRUNED_TWEETS = False
+    PRUNE_BATCH_SIZE = 500
+    IMPORT_BATCH_SIZE = 5000
+    REPLAY_BATCH_SIZE = 5000
+    INCREMENTAL_VACUUM_PAGES = 2000
+    MAINTENANCE_INTERVAL = 60 * 60
+
+
+class NearDuplicateConstants:
+    # A tweet is suppressed when it is this similar (estimated Jaccard similarity of the character shingles)
+    # to a tweet of the last WINDOW seconds
+    WINDOW = 30 * 60
+    SIMILARITY_THRESHOLD = 0.7
+    SHINGLE_SIZE = 5
+    BANDS = 16
+
+
+class ImageResolverConstants:
+    CACHE_TTL = 6 * 60 * 60
+    MAX_CACHED_KEYWORDS = 256
+    # Keywords looked up at least REFRESH_MIN_HITS times are refreshed in the background once this share of the TTL passed
+    REFRESH_AHEAD_RATIO = 0.8
+    REFRESH_MIN_HITS = 3
+    REQUEST_TIMEOUT = 10
+    MAX_CONNECTIONS = 10
+
+
+class PollingConstants:
+    INITIAL_INTERVAL = 45
+    MIN_INTERVAL = 15
+    MAX_INTERVAL = 180
+    BACKOFF_FACTOR = 1.5
+
+
+class DeliveryConstants:
+    GLOBAL_MESSAGES_PER_SECOND = 30
+    GROUP_MESSAGES_PER_MINUTE = 20
+    PRIVATE_CHAT_MESSAGES_PER_SECOND = 1
+    MAX_CONCURRENT_SENDS = 20
+    MAX_RETRY_AFTER_ATTEMPTS = 3
+    # Messages being sent before the pipeline waits for some of them to go out
+    MAX_PENDING_MESSAGES = 1000
+
+
+class MetricsConstants:
+    # The Prometheus endpoint is only reachable locally by default
+    HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    PORT = int(os.getenv("METRICS_PORT", 9108))
+
+
+class DigestConstants:
+    # Telegram rejects longer messages
+    MAX_MESSAGE_LENGTH = 4096
+    # Upper bound of a chat's digest window, so a match never waits longer than this
+    MAX_WINDOW = 10 * 60
+
+
+class PipelineConstants:
+    QUEUE_SIZE = 500
+    MAX_BATCH_SIZE = 100
+    # How long the shutdown waits for the queued tweets and messages to go out
+    DRAIN_TIMEOUT = 30
+
+
+class LoggingConstants:
+    LOG_DIRECTORY = 'log'
+    # The log files are rolled over at midnight and when they reach MAX_BYTES
+    MAX_BYTES = 20 * 1024 * 1024
+    BACKUP_COUNT = 14
+    # One in SAMPLE_RATE of the per tweet and per send events is kept
+    SAMPLE_RATE = 100
+    TWSCRAPE_LOG_LEVEL = os.getenv("TWSCRAPE_LOG_LEVEL", "WARNING")
+
+
+class WorkerConstants:
+    # 0 scrapes in the bot process, N starts N scraper processes and the bot only claims and sends the tweets
+    SCRAPER_WORKERS = int(os.getenv("SCRAPER_WORKERS", 0))
+    # Each worker keeps the sessions of its twitter accounts in its own twscrape database
+    ACCOUNTS_DB = 'accounts_worker_{}.db'
+    LOG_FILE = 'scraper_worker_{}.log'
+    STOP_TIMEOUT = 30
+
+
+class AccountPoolConstants:
+    # twscrape names the queue of the user timeline requests after the GraphQL operation
+    TIMELINE_QUEUE = 'UserTweets'
+    # Weight of the newest request in the error rate and latency moving averages
+    HEALTH_SMOOTHING = 0.2
+    CIRCUIT_BREAKER_MIN_OPEN = 60
+    CIRCUIT_BREAKER_MAX_OPEN = 15 * 60
+
+
 TwitterAccount = namedtuple('TwitterAccount', ['username', 'password', 'email', 'email_password'])
 
 
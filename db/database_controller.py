@@ -1,125 +1,454 @@
+import logging
 import os
 import sqlite3
 import asyncio
-from datetime import datetime
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 from sqlite3.dbapi2 import IntegrityError
 
-from constants import BotConstants
+from constants import BotConstants, DatabaseConstants
 from db.db_utilities import async_retry_on_lock
+from db.migrations import apply_migrations, enable_incremental_auto_vacuum, is_incremental_auto_vacuum_enabled
+from db.sqlite_engine import SqliteEngine
+from near_duplicates import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+BotState = namedtuple('BotState', ['subscribed_chat_ids', 'monitored_users', 'filter_keywords',
+                                   'chat_filter_keywords', 'chat_digest_windows'])
 
 
 class Tweet:
-    def __init__(self, tweet_id, date, is_posted, message, author):
+    # date is a UTC epoch timestamp in seconds
+    __slots__ = ('tweet_id', 'date', 'is_posted', 'message', 'author', 'fingerprint')
+
+    def __init__(self, tweet_id, date, is_posted, message, author, fingerprint=None):
         self.tweet_id = tweet_id
         self.date = date
         self.is_posted = is_posted
         self.message = message
         self.author = author
+        self.fingerprint = fingerprint
+
+    @property
+    def created_at(self):
+        return datetime.fromtimestamp(self.date, timezone.utc)
+
+    def __repr__(self):
+        return f'Tweet({self.tweet_id}, {self.created_at:%Y-%m-%d %H:%M:%S}, {self.author}, {self.message!r})'
 
 
 class DatabaseController:
     # Resolve absolute DB path and ensure directory exists
     DB_NAME = os.path.abspath(BotConstants.DATABASE_PATH)
-    DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
-    DATE_FORMAT = '%Y-%m-%d'
 
     def __init__(self):
         os.makedirs(os.path.dirname(self.DB_NAME), exist_ok=True)
-        self.lock = asyncio.Lock()
+        self.engine = SqliteEngine(self.DB_NAME)
         self._initialize_db()
 
-    def _get_connection(self):
-        conn = sqlite3.connect(self.DB_NAME, timeout=10, check_same_thread=False)
-        try:
-            conn.execute('PRAGMA journal_mode=WAL')
-        except sqlite3.OperationalError as e:
-            print(f"Warning: Could not set journal_mode to WAL: {e}")
-        return conn
+    def close(self):
+        # Applies the queued write-behind writes first
+        self.engine.close()
 
     def _initialize_db(self):
-        conn = None
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS tweets (
-                    id INTEGER PRIMARY KEY,
-                    tweet_id INTEGER UNIQUE,
-                    is_posted INTEGER,
-                    date TEXT,
-                    message TEXT,
-                    author TEXT
-                )
-            ''')
-            conn.commit()
+            self.engine.write_sync(apply_migrations)
+            if not self.engine.read_sync(is_incremental_auto_vacuum_enabled):
+                logger.info("Incremental vacuum is not enabled yet, the space of the pruned tweets isn't returned. "
+                            "Stop the bot and run 'python tweet_archive.py vacuum' once to enable it.")
         except sqlite3.OperationalError as e:
-            print(f"Error initializing database: {e}")
+            logger.error("Error initializing database: %s", e)
             raise
-        finally:
-            if conn:
-                conn.close()
+
+    def enable_incremental_auto_vacuum(self):
+        # One-off full VACUUM, see enable_incremental_auto_vacuum. Returns False when it was already enabled.
+        return self.engine.write_sync(enable_incremental_auto_vacuum)
+
+    @staticmethod
+    def to_epoch(datetime_obj):
+        # Naive datetimes are taken as local time, like datetime.now()
+        return int(datetime_obj.timestamp())
+
+    def _get_today_bounds(self):
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        tomorrow = today + timedelta(days=1)
+        return self.to_epoch(today), self.to_epoch(tomorrow)
+
+    def _tweet_to_row(self, tweet):
+        return tweet.id, self.to_epoch(tweet.date), False, tweet.rawContent, tweet.user.username
+
+    @staticmethod
+    def _add_fingerprint(row):
+        # Called on the writer thread, so the MinHash doesn't run on the event loop
+        return *row, fingerprint(row[3])
 
     @async_retry_on_lock()
     async def insert_tweet(self, tweet):
-        tweet_id = tweet.id
-        date = tweet.date.strftime(self.DATETIME_FORMAT)
-        message = tweet.rawContent
-        author = tweet.user.username
-        is_posted = False
-
-        async with self.lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            try:
-                cursor.execute('''
-                    INSERT INTO tweets (tweet_id, date, is_posted, message, author)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (tweet_id, date, is_posted, message, author))
-                conn.commit()
-            except IntegrityError:
-                pass  # Tweet already exists
-            finally:
-                conn.close()
+        await self.engine.write(self._insert_tweet, self._tweet_to_row(tweet))
+
+    @staticmethod
+    def _insert_tweet(conn, row):
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT INTO tweets (tweet_id, date, is_posted, message, author, fingerprint)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', DatabaseController._add_fingerprint(row))
+        except IntegrityError:
+            pass  # Tweet already exists
+
+    @async_retry_on_lock()
+    async def insert_tweets(self, tweets, author=None):
+        # Writes a whole fetch in one transaction, returns the number of tweets that were not already stored.
+        # When the author is given, their timeline high-water mark is advanced in the same transaction.
+        rows = [self._tweet_to_row(tweet) for tweet in tweets]
+        if not rows:
+            return 0
+        return await self.engine.write(self._insert_tweets, rows, author)
+
+    @staticmethod
+    def _insert_tweets(conn, rows, author):
+        rows_with_fingerprints = [DatabaseController._add_fingerprint(row) for row in rows]
+        with conn:
+            changes_before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO tweets (tweet_id, date, is_posted, message, author, fingerprint)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows_with_fingerprints)
+            inserted = conn.total_changes - changes_before
+
+            if author:
+                conn.execute('''
+                    INSERT INTO timeline_cursors (author, last_tweet_id) VALUES (?, ?)
+                    ON CONFLICT(author) DO UPDATE SET last_tweet_id = MAX(last_tweet_id, excluded.last_tweet_id)
+                ''', (author, max(row[0] for row in rows)))
+            return inserted
+
+    async def get_last_tweet_id(self, author):
+        return await self.engine.read(self._select_last_tweet_id, author)
+
+    @staticmethod
+    def _select_last_tweet_id(conn, author):
+        row = conn.execute('''
+            SELECT last_tweet_id FROM timeline_cursors WHERE author = ?
+        ''', (author,)).fetchone()
+        return row[0] if row else None
 
     async def retrieve_tweets_by_author(self, author):
-        async with self.lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT tweet_id, date, is_posted, message, author
-                FROM tweets WHERE author = ?
-            ''', (author,))
-            rows = cursor.fetchall()
-            conn.close()
-        return rows
+        rows = await self.engine.read(self._select_tweets_by_author, author)
+        return [Tweet(*row) for row in rows]
 
-    async def retrieve_today_unposted_tweets(self, author):
-        today = datetime.now().strftime(self.DATE_FORMAT)
-        async with self.lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT tweet_id, date, is_posted, message, author
-                FROM tweets
-                WHERE author = ? AND strftime('%Y-%m-%d', date) = ? AND is_posted = 0
-                ORDER BY date
-            ''', (author, today))
-            rows = cursor.fetchall()
-            conn.close()
+    @staticmethod
+    def _select_tweets_by_author(conn, author):
+        return conn.execute('''
+            SELECT tweet_id, date, is_posted, message, author
+            FROM tweets WHERE author = ?
+        ''', (author,)).fetchall()
 
+    async def retrieve_today_unposted_tweets(self, author):
+        rows = await self.engine.read(self._select_today_unposted_tweets, author, *self._get_today_bounds())
         return [Tweet(*row) for row in rows]
 
+    @staticmethod
+    def _select_today_unposted_tweets(conn, author, day_start, day_end):
+        return conn.execute('''
+            SELECT tweet_id, date, is_posted, message, author
+            FROM tweets
+            WHERE author = ? AND is_posted = 0 AND date >= ? AND date < ?
+            ORDER BY date
+        ''', (author, day_start, day_end)).fetchall()
+
+    @async_retry_on_lock()
+    async def claim_today_unposted_tweets(self, authors, window_start=None, window_end=None):
+        # Marks today's unposted tweets of the authors as posted and returns the ones in [window_start, window_end)
+        # in the same transaction, so overlapping jobs (or bot processes) can never claim the same tweet twice.
+        # Today's tweets outside the window are marked as posted without being loaded.
+        authors = list(authors)
+        if not authors:
+            return []
+        day_start, day_end = self._get_today_bounds()
+        window_start = self.to_epoch(window_start) if window_start else day_start
+        window_end = self.to_epoch(window_end) if window_end else day_end
+        rows = await self.engine.write(self._claim_today_unposted_tweets, authors, day_start, day_end,
+                                       max(window_start, day_start), min(window_end, day_end))
+        return [Tweet(*row) for row in sorted(rows, key=lambda row: row[1])]
+
+    @staticmethod
+    def _claim_today_unposted_tweets(conn, authors, day_start, day_end, window_start, window_end):
+        authors_placeholders = ','.join('?' * len(authors))
+        with conn:
+            rows = conn.execute(f'''
+                UPDATE tweets
+                SET is_posted = 1
+                WHERE author IN ({authors_placeholders}) AND is_posted = 0 AND date >= ? AND date < ?
+                RETURNING tweet_id, date, is_posted, message, author, fingerprint
+            ''', (*authors, window_start, window_end)).fetchall()
+            conn.execute(f'''
+                UPDATE tweets
+                SET is_posted = 1
+                WHERE author IN ({authors_placeholders}) AND is_posted = 0 AND date >= ? AND date < ?
+            ''', (*authors, day_start, day_end))
+        return rows
+
+    @async_retry_on_lock()
     async def mark_tweet_as_posted(self, tweet_id):
-        async with self.lock:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
+        await self.engine.write(self._update_tweet_as_posted, tweet_id)
+
+    @staticmethod
+    def _update_tweet_as_posted(conn, tweet_id):
+        with conn:
+            conn.execute('''
                 UPDATE tweets
                 SET is_posted = 1
                 WHERE tweet_id = ?
             ''', (tweet_id,))
-            conn.commit()
-            conn.close()
+
+    @async_retry_on_lock()
+    async def release_tweets(self, tweet_ids):
+        # Marks claimed tweets that weren't sent as unposted again, so the next claim picks them up
+        tweet_ids = list(tweet_ids)
+        if tweet_ids:
+            await self.engine.write(self._release_tweets, tweet_ids)
+
+    @staticmethod
+    def _release_tweets(conn, tweet_ids):
+        with conn:
+            conn.executemany('''
+                UPDATE tweets
+                SET is_posted = 0
+                WHERE tweet_id = ?
+            ''', [(tweet_id,) for tweet_id in tweet_ids])
+
+    async def prune_tweets_older_than(self, cutoff, archive=False, batch_size=DatabaseConstants.PRUNE_BATCH_SIZE):
+        # Deletes (or moves to tweets_archive) the tweets older than cutoff in small transactions,
+        # so other writes can run between the batches. Returns the number of pruned tweets.
+        cutoff = self.to_epoch(cutoff)
+        pruned = 0
+        while True:
+            batch_pruned = await self.engine.write(self._prune_tweets_batch, cutoff, archive, batch_size)
+            pruned += batch_pruned
+            if batch_pruned < batch_size:
+                return pruned
+
+    @staticmethod
+    def _prune_tweets_batch(conn, cutoff, archive, batch_size):
+        with conn:
+            ids = [row[0] for row in conn.execute('''
+                SELECT id FROM tweets WHERE date < ? ORDER BY date LIMIT ?
+            ''', (cutoff, batch_size))]
+            if not ids:
+                return 0
+
+            ids_placeholders = ','.join('?' * len(ids))
+            if archive:
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO tweets_archive (tweet_id, is_posted, date, message, author)
+                    SELECT tweet_id, is_posted, date, message, author FROM tweets WHERE id IN ({ids_placeholders})
+                ''', ids)
+            conn.execute(f'DELETE FROM tweets WHERE id IN ({ids_placeholders})', ids)
+        return len(ids)
+
+    async def compact(self, pages=DatabaseConstants.INCREMENTAL_VACUUM_PAGES):
+        # Returns the bytes released from the database file, the WAL frames checkpointed and in the WAL, and the WAL
+        # size after the checkpoint. The vacuum itself writes to the WAL, so the WAL can grow even while the database
+        # shrinks; the WAL file is reused from the start and truncated to JOURNAL_SIZE_LIMIT once fully checkpointed.
+        wal_path = f'{self.DB_NAME}-wal'
+        reclaimed_bytes, wal_frames, checkpointed_frames = await self.engine.write(self._compact, pages)
+        wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        return reclaimed_bytes, checkpointed_frames, wal_frames, wal_size
+
+    @staticmethod
+    def _compact(conn, pages):
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count_before = conn.execute('PRAGMA page_count').fetchone()[0]
+        # executescript steps the pragma to completion, a plain execute would only free a single page
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        page_count_after = conn.execute('PRAGMA page_count').fetchone()[0]
+        # PASSIVE never waits for readers or writers, it checkpoints whatever it can right now
+        _, wal_frames, checkpointed_frames = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return (page_count_before - page_count_after) * page_size, wal_frames, checkpointed_frames
+
+    async def get_claimed_fingerprints(self, authors, since, window_start=None, window_end=None):
+        # (date, fingerprint) of the authors' tweets dated after since that were handed out by
+        # claim_today_unposted_tweets, the ones in the window. Used to seed the near-duplicate index after a restart.
+        authors = list(authors)
+        if not authors:
+            return []
+        day_start, day_end = self._get_today_bounds()
+        window_start = self.to_epoch(window_start) if window_start else day_start
+        window_end = self.to_epoch(window_end) if window_end else day_end
+        return await self.engine.read(self._select_claimed_fingerprints, authors,
+                                      max(self.to_epoch(since), window_start, day_start), min(window_end, day_end))
+
+    @staticmethod
+    def _select_claimed_fingerprints(conn, authors, start, end):
+        return conn.execute(f'''
+            SELECT date, fingerprint FROM tweets
+            WHERE author IN ({','.join('?' * len(authors))}) AND is_posted = 1 AND date >= ? AND date < ?
+                AND fingerprint IS NOT NULL
+            ORDER BY date
+        ''', (*authors, start, end)).fetchall()
+
+    async def get_cached_user_id(self, username, max_age):
+        return await self.engine.read(self._select_cached_user_id, username, int(time.time()) - max_age)
+
+    @staticmethod
+    def _select_cached_user_id(conn, username, resolved_after):
+        row = conn.execute('''
+            SELECT user_id FROM twitter_users WHERE username = ? AND resolved_at >= ?
+        ''', (username, resolved_after)).fetchone()
+        return row[0] if row else None
+
+    @async_retry_on_lock()
+    async def save_user_id(self, username, user_id):
+        await self.engine.write(self._upsert_user_id, username, user_id, int(time.time()))
+
+    @staticmethod
+    def _upsert_user_id(conn, username, user_id, resolved_at):
+        with conn:
+            conn.execute('''
+                INSERT INTO twitter_users (username, user_id, resolved_at) VALUES (?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET user_id = excluded.user_id, resolved_at = excluded.resolved_at
+            ''', (username, user_id, resolved_at))
+
+    # The bulk methods below are synchronous, they are used by the archive CLI and not by the bot
+
+    def import_tweet_batches(self, batches):
+        # batches is an iterable of lists of (tweet_id, date, message, author) rows. Each batch is written in its own
+        # transaction on the writer thread while the next one is being read, so at most two batches are in memory.
+        # Imported tweets are stored as posted, they are history and must never be sent, so they get no fingerprint
+        # either. Tweets older than RETENTION_DAYS go straight to tweets_archive, the maintenance job would delete
+        # them from tweets. Returns the number of tweets that were not already stored.
+        cutoff = self.to_epoch(datetime.now() - timedelta(days=DatabaseConstants.RETENTION_DAYS))
+        imported = 0
+        pending_write = None
+        for rows in batches:
+            write = self.engine.submit_write(self._import_tweet_rows, rows, cutoff)
+            if pending_write is not None:
+                imported += pending_write.result()
+            pending_write = write
+        if pending_write is not None:
+            imported += pending_write.result()
+        return imported
+
+    @staticmethod
+    def _import_tweet_rows(conn, rows, cutoff):
+        with conn:
+            changes_before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO tweets (tweet_id, date, is_posted, message, author)
+                VALUES (?, ?, 1, ?, ?)
+            ''', [row for row in rows if row[1] >= cutoff])
+            conn.executemany('''
+                INSERT OR IGNORE INTO tweets_archive (tweet_id, date, is_posted, message, author)
+                VALUES (?, ?, 1, ?, ?)
+            ''', [row for row in rows if row[1] < cutoff])
+            return conn.total_changes - changes_before
+
+    def iterate_tweets(self, start=None, end=None, authors=None, batch_size=DatabaseConstants.REPLAY_BATCH_SIZE):
+        # Streams the tweets dated in [start, end), the live ones and then the archived ones, page by page.
+        # Pages are read by keyset on (date, rowid), which is the order of the date indexes, so every page is an
+        # index range scan no matter how deep into the table it is.
+        start = self.to_epoch(start) if start else 0
+        end = self.to_epoch(end) if end else 2 ** 63 - 1
+        authors = list(authors) if authors else None
+        for table in ('tweets', 'tweets_archive'):
+            last_date, last_rowid = start, -1
+            while True:
+                rows = self.engine.read_sync(self._select_tweets_page, table, last_date, last_rowid, end, authors,
+                                             batch_size)
+                for row in rows:
+                    yield Tweet(*row[1:])
+                if len(rows) < batch_size:
+                    break
+                last_rowid, last_date = rows[-1][0], rows[-1][2]
+
+    @staticmethod
+    def _select_tweets_page(conn, table, last_date, last_rowid, end, authors, batch_size):
+        authors_filter = f"AND author IN ({','.join('?' * len(authors))})" if authors else ''
+        return conn.execute(f'''
+            SELECT rowid, tweet_id, date, is_posted, message, author FROM {table}
+            WHERE date >= ? AND (date, rowid) > (?, ?) AND date < ? {authors_filter}
+            ORDER BY date, rowid
+            LIMIT ?
+        ''', (last_date, last_date, last_rowid, end, *(authors or ()), batch_size)).fetchall()
+
+    async def get_monitored_usernames(self):
+        # Without the leading @, like BotDataProcessor.get_formatted_monitored_usernames
+        return await self.engine.read(self._select_monitored_usernames)
+
+    @staticmethod
+    def _select_monitored_usernames(conn):
+        return sorted(row[0][1:] for row in conn.execute('SELECT username FROM monitored_users'))
+
+    def load_bot_state(self):
+        return self.engine.read_sync(self._select_bot_state)
+
+    @staticmethod
+    def _select_bot_state(conn):
+        chat_filter_keywords = {}
+        for chat_id, keyword in conn.execute('SELECT chat_id, keyword FROM chat_filter_keywords'):
+            chat_filter_keywords.setdefault(chat_id, set()).add(keyword)
+        return BotState(
+            subscribed_chat_ids={row[0] for row in conn.execute('SELECT chat_id FROM subscribed_chats')},
+            monitored_users={row[0] for row in conn.execute('SELECT username FROM monitored_users')},
+            filter_keywords={row[0] for row in conn.execute('SELECT keyword FROM filter_keywords')},
+            chat_filter_keywords=chat_filter_keywords,
+            chat_digest_windows=dict(conn.execute('SELECT chat_id, window FROM chat_digest_windows').fetchall()),
+        )
+
+    # The bot state writes below are write-behind: they return a Future immediately and are applied in order,
+    # each in its own transaction, by the writer thread. Only the rows that changed are written.
+
+    def save_subscribed_chat(self, chat_id, is_subscribed):
+        return self.engine.submit_write(self._update_subscribed_chat, chat_id, is_subscribed)
+
+    @staticmethod
+    def _update_subscribed_chat(conn, chat_id, is_subscribed):
+        with conn:
+            if is_subscribed:
+                conn.execute('INSERT OR IGNORE INTO subscribed_chats (chat_id) VALUES (?)', (chat_id,))
+            else:
+                conn.execute('DELETE FROM subscribed_chats WHERE chat_id = ?', (chat_id,))
+
+    def save_monitored_users_changes(self, added, removed):
+        return self.engine.submit_write(self._update_set_table, 'monitored_users', 'username', added, removed)
+
+    def save_filter_keywords_changes(self, added, removed):
+        return self.engine.submit_write(self._update_set_table, 'filter_keywords', 'keyword', added, removed)
+
+    @staticmethod
+    def _update_set_table(conn, table, column, added, removed):
+        with conn:
+            conn.executemany(f'DELETE FROM {table} WHERE {column} = ?', [(value,) for value in removed])
+            conn.executemany(f'INSERT OR IGNORE INTO {table} ({column}) VALUES (?)', [(value,) for value in added])
+
+    def save_chat_filter_keywords(self, chat_id, keywords):
+        return self.engine.submit_write(self._replace_chat_filter_keywords, chat_id, list(keywords))
+
+    @staticmethod
+    def _replace_chat_filter_keywords(conn, chat_id, keywords):
+        with conn:
+            conn.execute('DELETE FROM chat_filter_keywords WHERE chat_id = ?', (chat_id,))
+            conn.executemany('INSERT INTO chat_filter_keywords (chat_id, keyword) VALUES (?, ?)',
+                             [(chat_id, keyword) for keyword in keywords])
+
+    def save_chat_digest_window(self, chat_id, window):
+        return self.engine.submit_write(self._update_chat_digest_window, chat_id, window)
+
+    @staticmethod
+    def _update_chat_digest_window(conn, chat_id, window):
+        with conn:
+            if window:
+                conn.execute('''
+                    INSERT INTO chat_digest_windows (chat_id, window) VALUES (?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET window = excluded.window
+                ''', (chat_id, window))
+            else:
+                conn.execute('DELETE FROM chat_digest_windows WHERE chat_id = ?', (chat_id,))
 
 
 if __name__ == "__main__":
@@ -130,6 +459,7 @@ if __name__ == "__main__":
         tweets = await controller.retrieve_tweets_by_author('FinancialPear')
         for tweet in tweets:
             print(tweet)
+        controller.close()
 
         # Example: insert, retrieve, and mark tweets
         # from twitter_scraper import TwitterScraper
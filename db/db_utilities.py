@@ -2,6 +2,8 @@ import asyncio
 import functools
 import sqlite3
 
+from metrics import DB_LOCK_RETRIES
+
 
 def async_retry_on_lock(max_retries=5, delay=0.2):
     def decorator(func):
@@ -13,6 +15,7 @@ def async_retry_on_lock(max_retries=5, delay=0.2):
                 except sqlite3.OperationalError as e:
                     if "database is locked" in str(e).lower():
                         if attempt < max_retries - 1:
+                            DB_LOCK_RETRIES.inc(operation=func.__name__)
                             await asyncio.sleep(delay * (2 ** attempt))
                         else:
                             raise sqlite3.OperationalError(
@@ -0,0 +1,218 @@
+import json
+import logging
+import sqlite3
+
+from constants import BotConstants, ScraperConstants
+
+logger = logging.getLogger(__name__)
+
+
+def _create_tweets_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tweets (
+            id INTEGER PRIMARY KEY,
+            tweet_id INTEGER UNIQUE,
+            is_posted INTEGER,
+            date TEXT,
+            message TEXT,
+            author TEXT
+        )
+    ''')
+
+
+def _add_tweets_author_is_posted_date_index(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tweets_author_is_posted_date
+        ON tweets (author, is_posted, date)
+    ''')
+
+
+def _create_timeline_cursors_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timeline_cursors (
+            author TEXT PRIMARY KEY COLLATE NOCASE,
+            last_tweet_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO timeline_cursors (author, last_tweet_id)
+        SELECT author, MAX(tweet_id) FROM tweets WHERE author IS NOT NULL GROUP BY author
+    ''')
+
+
+def _store_tweet_dates_as_epoch_integers(conn):
+    # SQLite can't change a column type in place, so the table is rebuilt. The TEXT dates were written in UTC.
+    conn.execute('''
+        CREATE TABLE tweets_new (
+            id INTEGER PRIMARY KEY,
+            tweet_id INTEGER UNIQUE,
+            is_posted INTEGER,
+            date INTEGER,
+            message TEXT,
+            author TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO tweets_new (id, tweet_id, is_posted, date, message, author)
+        SELECT id, tweet_id, is_posted, CAST(strftime('%s', date) AS INTEGER), message, author FROM tweets
+    ''')
+    conn.execute('DROP TABLE tweets')
+    conn.execute('ALTER TABLE tweets_new RENAME TO tweets')
+    _add_tweets_author_is_posted_date_index(conn)
+
+
+def _create_tweets_archive_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tweets_archive (
+            tweet_id INTEGER PRIMARY KEY,
+            is_posted INTEGER,
+            date INTEGER,
+            message TEXT,
+            author TEXT
+        )
+    ''')
+
+
+def _read_legacy_json_file(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        # Keep the corrupted file around so it can be recovered by hand
+        logger.warning("Could not import '%s': %s", path, e)
+        return {}
+
+
+def _read_legacy_lines_file(path):
+    try:
+        with open(path, 'r') as file:
+            return [line.strip() for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _create_bot_state_tables(conn):
+    # chat_id has no declared type on purpose, chat ids can be ints (chats) or strings (channels passed as arguments)
+    conn.execute('CREATE TABLE IF NOT EXISTS subscribed_chats (chat_id PRIMARY KEY)')
+    conn.execute('CREATE TABLE IF NOT EXISTS monitored_users (username TEXT PRIMARY KEY)')
+    conn.execute('CREATE TABLE IF NOT EXISTS filter_keywords (keyword TEXT PRIMARY KEY)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_filter_keywords (
+            chat_id,
+            keyword TEXT,
+            PRIMARY KEY (chat_id, keyword)
+        )
+    ''')
+
+    # Import the state the bot used to keep in flat files
+    chat_ids = _read_legacy_json_file(BotConstants.SUBSCRIBED_CHAT_IDS_FILE).get('chat_ids', [])
+    conn.executemany('INSERT OR IGNORE INTO subscribed_chats (chat_id) VALUES (?)',
+                     [(chat_id,) for chat_id in chat_ids])
+    conn.executemany('INSERT OR IGNORE INTO monitored_users (username) VALUES (?)',
+                     [(username,) for username in _read_legacy_lines_file(BotConstants.MONITORED_USER_FILE)])
+    conn.executemany('INSERT OR IGNORE INTO filter_keywords (keyword) VALUES (?)',
+                     [(keyword,) for keyword in _read_legacy_lines_file(BotConstants.FILTER_KEYWORDS_FILE)])
+    chats = _read_legacy_json_file(BotConstants.CHAT_FILTER_KEYWORDS_FILE).get('chats', [])
+    conn.executemany('INSERT OR IGNORE INTO chat_filter_keywords (chat_id, keyword) VALUES (?, ?)',
+                     [(chat['chat_id'], keyword) for chat in chats for keyword in chat['keywords']])
+
+
+def _create_twitter_users_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS twitter_users (
+            username TEXT PRIMARY KEY COLLATE NOCASE,
+            user_id INTEGER NOT NULL,
+            resolved_at INTEGER NOT NULL
+        )
+    ''')
+
+    # Import the users resolved into the old cache file
+    data = _read_legacy_json_file(ScraperConstants.MONITORED_USER_DATA_FILE)
+    if isinstance(data, str):
+        # Single double-encoded user
+        user = json.loads(data)
+        data = {user['username']: user}
+    conn.executemany('''
+        INSERT OR IGNORE INTO twitter_users (username, user_id, resolved_at)
+        VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+    ''', [(user['username'], user['id']) for user in data.values()])
+
+
+def _add_tweets_archive_date_index(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tweets_archive_date ON tweets_archive (date)')
+
+
+def _add_tweets_fingerprint_column(conn):
+    # Near-duplicate fingerprint, NULL for the tweets stored before it existed
+    conn.execute('ALTER TABLE tweets ADD COLUMN fingerprint BLOB')
+
+
+def _create_chat_digest_windows_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_digest_windows (
+            chat_id PRIMARY KEY,
+            window INTEGER NOT NULL
+        )
+    ''')
+
+
+def _add_tweets_date_index(conn):
+    # For the retention pruning, which selects by date alone. Databases that created tweets_archive before this
+    # migration existed already have it.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tweets_date ON tweets (date)')
+
+
+# Append only. The position in the list is the schema version stored in PRAGMA user_version after it is applied.
+MIGRATIONS = [
+    _create_tweets_table,
+    _add_tweets_author_is_posted_date_index,
+    _create_timeline_cursors_table,
+    _store_tweet_dates_as_epoch_integers,
+    _create_tweets_archive_table,
+    _create_bot_state_tables,
+    _create_twitter_users_table,
+    _add_tweets_archive_date_index,
+    _add_tweets_fingerprint_column,
+    _create_chat_digest_windows_table,
+    _add_tweets_date_index,
+]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def apply_migrations(conn):
+    while True:
+        # BEGIN IMMEDIATE takes the write lock before the version is read, so two processes starting at the same
+        # time can't both apply the same migration
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = get_schema_version(conn)
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return version
+
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def is_incremental_auto_vacuum_enabled(conn):
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def enable_incremental_auto_vacuum(conn):
+    # Changing auto_vacuum on an existing database only takes effect after a VACUUM, which can't run in a
+    # transaction and rewrites the whole file, so it is a one-off step run by hand (python tweet_archive.py vacuum).
+    # Afterwards free pages are returned with PRAGMA incremental_vacuum.
+    if is_incremental_auto_vacuum_enabled(conn):
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import DatabaseConstants
+from metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteEngine:
+    # One writer connection living on a dedicated thread (so all writes are serialized without an asyncio lock)
+    # and a small pool of read-only connections, each pinned to its own reader thread.
+    # sqlite3 keeps a per-connection prepared statement cache keyed by the SQL text, so as long as the callers
+    # reuse the same query strings the statements are compiled once per connection and reused afterwards.
+
+    def __init__(self, db_path, read_pool_size=DatabaseConstants.READ_POOL_SIZE):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer',
+                                          initializer=self._open_thread_connection, initargs=(False,))
+        self._readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix='db-reader',
+                                           initializer=self._open_thread_connection, initargs=(True,))
+
+    def _connect(self, read_only):
+        conn = sqlite3.connect(self.db_path, timeout=DatabaseConstants.BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=DatabaseConstants.STATEMENT_CACHE_SIZE)
+        if read_only:
+            conn.execute('PRAGMA query_only=ON')
+        else:
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.OperationalError as e:
+                logger.warning("Could not set journal_mode to WAL: %s", e)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA journal_size_limit={DatabaseConstants.JOURNAL_SIZE_LIMIT}')
+        return conn
+
+    def _open_thread_connection(self, read_only):
+        conn = self._connect(read_only)
+        self._local.connection = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+
+    def _run(self, func, args):
+        with DB_OPERATION_SECONDS.time(operation=func.__name__.lstrip('_')):
+            return func(self._local.connection, *args)
+
+    async def write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run, func, args)
+
+    async def read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run, func, args)
+
+    def write_sync(self, func, *args):
+        return self._writer.submit(self._run, func, args).result()
+
+    def read_sync(self, func, *args):
+        return self._readers.submit(self._run, func, args).result()
+
+    def submit_write(self, func, *args):
+        # Write-behind: queues the write on the writer thread and returns its concurrent.futures.Future right away
+        future = self._writer.submit(self._run, func, args)
+        future.add_done_callback(self._report_failed_write)
+        return future
+
+    @staticmethod
+    def _report_failed_write(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Error writing to database: %s", future.exception())
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
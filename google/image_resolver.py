@@ -0,0 +1,128 @@
+import asyncio
+import html
+import logging
+import re
+import time
+from collections import OrderedDict
+from random import randrange
+from urllib.parse import urljoin
+
+import httpx
+
+from constants import ImageResolverConstants
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = 'https://www.google.com'
+SEARCH_URL = f'{BASE_URL}/search'
+IMG_SRC_PATTERN = re.compile(rb'<img\b[^>]*?\ssrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+
+def parse_image_urls(content, base_url=BASE_URL):
+    # Only the src of the img tags is needed, so a regex over the raw bytes replaces building a whole soup
+    return [urljoin(base_url, html.unescape(src.decode('utf-8', 'replace')))
+            for src in IMG_SRC_PATTERN.findall(content)]
+
+
+def pick_random_image_url(image_urls):
+    # Same choice as get_random_google_image: the first and last few images are page elements, not results
+    candidates = image_urls[3:-3] or image_urls[3:]
+    if not candidates:
+        return None
+    return candidates[randrange(len(candidates))]
+
+
+class CachedImages:
+    __slots__ = ('image_urls', 'fetched_at', 'hits')
+
+    def __init__(self, image_urls, fetched_at):
+        self.image_urls = image_urls
+        self.fetched_at = fetched_at
+        self.hits = 0
+
+
+class ImageResolver:
+    # Async replacement for get_random_google_image. Uses one pooled HTTP client, caches the image urls per keyword
+    # with a TTL and LRU eviction, and refreshes popular keywords in the background before they expire.
+
+    def __init__(self, search_url=SEARCH_URL, client=None):
+        self.search_url = search_url
+        self._client = client
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._refresh_tasks = set()
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=ImageResolverConstants.REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_connections=ImageResolverConstants.MAX_CONNECTIONS,
+                                    max_keepalive_connections=ImageResolverConstants.MAX_CONNECTIONS),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def get_random_image(self, keyword):
+        now = time.monotonic()
+        entry = self._cache.get(keyword)
+        if entry is not None and now - entry.fetched_at < ImageResolverConstants.CACHE_TTL:
+            self._cache.move_to_end(keyword)
+            entry.hits += 1
+            if entry.hits >= ImageResolverConstants.REFRESH_MIN_HITS and \
+                    now - entry.fetched_at > ImageResolverConstants.CACHE_TTL * ImageResolverConstants.REFRESH_AHEAD_RATIO:
+                self._refresh_in_background(keyword)
+            return pick_random_image_url(entry.image_urls)
+
+        try:
+            image_urls = await self._fetch(keyword)
+        except httpx.HTTPError as e:
+            logger.error("Error searching images for '%s': %s", keyword, e)
+            # An expired entry is still better than no image at all
+            return pick_random_image_url(entry.image_urls) if entry is not None else None
+        return pick_random_image_url(image_urls)
+
+    def _fetch(self, keyword):
+        # Concurrent lookups of the same keyword share one request
+        task = self._in_flight.get(keyword)
+        if task is None:
+            task = asyncio.ensure_future(self._download(keyword))
+            self._in_flight[keyword] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(keyword, None))
+        return asyncio.shield(task)
+
+    async def _download(self, keyword):
+        response = await self._get_client().get(self.search_url, params={'q': keyword, 'tbm': 'isch'})
+        response.raise_for_status()
+        image_urls = parse_image_urls(response.content, str(response.url))
+
+        previous_entry = self._cache.pop(keyword, None)
+        entry = CachedImages(image_urls, time.monotonic())
+        if previous_entry is not None:
+            entry.hits = previous_entry.hits
+        self._cache[keyword] = entry
+        while len(self._cache) > ImageResolverConstants.MAX_CACHED_KEYWORDS:
+            self._cache.popitem(last=False)
+        return image_urls
+
+    def _refresh_in_background(self, keyword):
+        if keyword in self._in_flight:
+            return
+        task = asyncio.ensure_future(self._fetch(keyword))
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._on_refresh_done)
+
+    def _on_refresh_done(self, task):
+        self._refresh_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error refreshing cached images: %s", task.exception())
+
+    async def close(self):
+        # The lookups only await a shield of the downloads, so the downloads themselves are cancelled before the
+        # client is closed under them
+        tasks = [*self._refresh_tasks, *self._in_flight.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
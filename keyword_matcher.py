@@ -0,0 +1,129 @@
+from collections import defaultdict, deque
+
+
+class KeywordMatcher:
+    # Aho-Corasick automaton over the keyword set. It is compiled once and finds every keyword in a single pass
+    # over the text, instead of running `keyword in message` for every keyword.
+
+    def __init__(self, keywords, case_insensitive=False, whole_word=False):
+        self.case_insensitive = case_insensitive
+        self.whole_word = whole_word
+        self.keywords = tuple(dict.fromkeys(keyword for keyword in keywords if keyword))
+
+        self._patterns = [self._normalize(keyword) for keyword in self.keywords]
+        # With whole_word a boundary is only required on the sides where the keyword itself starts/ends
+        # with a word character (like regex \b), so '$META' matches '($META)' but not '$METAX'.
+        self._boundaries = [(self._is_word_char(pattern[0]), self._is_word_char(pattern[-1]))
+                            for pattern in self._patterns]
+        self._build()
+
+    def __bool__(self):
+        return bool(self.keywords)
+
+    @staticmethod
+    def _is_word_char(char):
+        return char.isalnum() or char == '_'
+
+    def _normalize(self, text):
+        return text.lower() if self.case_insensitive else text
+
+    def _build(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for keyword_index, pattern in enumerate(self._patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(keyword_index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                self._fail[next_state] = self._goto[fail_state].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _is_whole_word(self, text, keyword_index, end):
+        needs_start_boundary, needs_end_boundary = self._boundaries[keyword_index]
+        start = end - len(self._patterns[keyword_index]) + 1
+        if needs_start_boundary and start > 0 and self._is_word_char(text[start - 1]):
+            return False
+        if needs_end_boundary and end + 1 < len(text) and self._is_word_char(text[end + 1]):
+            return False
+        return True
+
+    def find(self, text):
+        # Returns the matched keywords (as originally given) in the order they are found in the text
+        text = self._normalize(text)
+        goto, fail, output = self._goto, self._fail, self._output
+
+        found = {}  # dict as an ordered set
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for keyword_index in output[state]:
+                if keyword_index in found:
+                    continue
+                if self.whole_word and not self._is_whole_word(text, keyword_index, position):
+                    continue
+                found[keyword_index] = None
+        return [self.keywords[keyword_index] for keyword_index in found]
+
+
+class KeywordSubscriptionIndex:
+    # Inverted index keyword -> subscribed chat ids. Each tweet is matched once against the union of all keywords
+    # and the hits are turned into the set of chats to deliver to, instead of matching the tweet once per chat.
+    # The automaton is only recompiled when the union of keywords changes, not on every (un)subscribe.
+
+    def __init__(self, case_insensitive=False, whole_word=False):
+        self.case_insensitive = case_insensitive
+        self.whole_word = whole_word
+        self._keyword_to_chat_ids = defaultdict(set)
+        self._chat_id_to_keywords = {}
+        self._matcher = None
+
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            self._matcher = KeywordMatcher(self._keyword_to_chat_ids.keys(),
+                                           case_insensitive=self.case_insensitive, whole_word=self.whole_word)
+        return self._matcher
+
+    def set_chat_keywords(self, chat_id, keywords):
+        self.remove_chat(chat_id)
+        keywords = set(keywords)
+        self._chat_id_to_keywords[chat_id] = keywords
+        for keyword in keywords:
+            if keyword not in self._keyword_to_chat_ids:
+                self._matcher = None
+            self._keyword_to_chat_ids[keyword].add(chat_id)
+
+    def remove_chat(self, chat_id):
+        for keyword in self._chat_id_to_keywords.pop(chat_id, ()):
+            chat_ids = self._keyword_to_chat_ids[keyword]
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self._keyword_to_chat_ids[keyword]
+                self._matcher = None
+
+    def get_chat_ids(self, keywords):
+        chat_ids = set()
+        for keyword in keywords:
+            chat_ids.update(self._keyword_to_chat_ids.get(keyword, ()))
+        return chat_ids
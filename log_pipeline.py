@@ -0,0 +1,115 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from twscrape.logger import logger as twscrape_logger
+
+from constants import BotConstants, LoggingConstants
+
+# Optional fields of the events, passed with extra={...}
+EVENT_FIELDS = ('chat_id', 'tweet_id', 'stage', 'duration', 'sample_rate')
+
+
+def _get_next_midnight(timestamp):
+    day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day + timedelta(days=1)).timestamp()
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, with the same keys for the same kind of event. The QueueHandler already merged the
+    # arguments and the traceback into the message.
+
+    def format(self, record):
+        message = record.getMessage()
+        event = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': message,
+        }
+        if BotConstants.IMPORTANT_LOG_MARKER in message:
+            event['important'] = True
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                event[field] = value
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps one in rate of the high volume events, the ones logged with extra={'sampled': True}, counted per message
+    # template. Warnings, errors and #IMPORTANT_LOG events are always kept.
+
+    def __init__(self, rate=LoggingConstants.SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self._counts = Counter()
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING:
+            return True
+        if BotConstants.IMPORTANT_LOG_MARKER in str(record.msg):
+            return True
+        self._counts[record.msg] += 1
+        record.sample_rate = self.rate
+        return (self._counts[record.msg] - 1) % self.rate == 0
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    # Rolls the file over when it reaches max_bytes and at midnight, keeping backup_count numbered files
+
+    def __init__(self, filename, max_bytes=LoggingConstants.MAX_BYTES, backup_count=LoggingConstants.BACKUP_COUNT):
+        super().__init__(filename, 'a', max_bytes, backup_count, encoding='utf-8')
+        # A file last written before today is rolled over on the first record
+        last_write = os.stat(self.baseFilename).st_mtime if os.path.exists(self.baseFilename) else time.time()
+        self.rollover_at = _get_next_midnight(last_write)
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = _get_next_midnight(time.time())
+
+
+def route_twscrape_logs(handler, level=LoggingConstants.TWSCRAPE_LOG_LEVEL):
+    # twscrape logs with loguru straight to stderr, its records go through the handler instead
+    twscrape_logger.remove()
+    twscrape_logger.add(handler, level=level, format='{message}')
+
+
+def setup_logging(log_file, log_directory=LoggingConstants.LOG_DIRECTORY, level=logging.INFO):
+    # The loggers only put the records on a queue, the formatting and the writes happen on the listener's thread
+    # so they never block the event loop. Returns the started listener, it is stopped at exit.
+    os.makedirs(log_directory, exist_ok=True)
+    file_handler = SizeAndTimeRotatingFileHandler(os.path.join(log_directory, log_file))
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                                  datefmt='%m/%d/%Y %I:%M:%S %p'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # Dropped before they are queued
+    queue_handler.addFilter(SamplingFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    route_twscrape_logs(queue_handler)
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,215 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from constants import MetricsConstants
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            for key, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [per bucket counts, sum, count]
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _render_value(self, key, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative_count = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative_count += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} '
+                         f'{cumulative_count}')
+        lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+def timed(histogram, **labels):
+    # Decorator for coroutine functions
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+POLL_CYCLE_SECONDS = REGISTRY.histogram('bot_poll_cycle_seconds', 'Duration of a whole poll and send cycle.')
+POLL_STAGE_SECONDS = REGISTRY.histogram('bot_poll_stage_seconds', 'Duration of each stage of a poll cycle.',
+                                        ('stage',))
+LAST_POLL_CYCLE_TIMESTAMP = REGISTRY.gauge('bot_last_poll_cycle_timestamp_seconds',
+                                           'Unix time at which the last poll cycle finished.')
+POLL_INTERVAL_SECONDS = REGISTRY.gauge('bot_poll_interval_seconds', 'Current adaptive polling interval.')
+MONITORED_USERS = REGISTRY.gauge('bot_monitored_users', 'Number of monitored twitter users.')
+SUBSCRIBED_CHATS = REGISTRY.gauge('bot_subscribed_chats', 'Number of chats the tweets are shared to.')
+
+TWEET_FETCH_SECONDS = REGISTRY.histogram('scraper_fetch_seconds', 'Duration of fetching and saving the new tweets '
+                                                                  'of one user.')
+TWEET_FETCH_ERRORS = REGISTRY.counter('scraper_fetch_errors_total', 'Failed fetches of a user timeline.')
+TWEETS_INGESTED = REGISTRY.counter('scraper_tweets_ingested_total', 'New tweets saved to the database.')
+TWEETS_SUPPRESSED = REGISTRY.counter('scraper_tweets_suppressed_total', 'Claimed tweets dropped as near-duplicates '
+                                                                       'of a recent tweet.')
+TWEETS_MATCHED = REGISTRY.counter('scraper_tweets_matched_total', 'Claimed tweets that matched a keyword.')
+
+DB_OPERATION_SECONDS = REGISTRY.histogram('db_operation_seconds', 'Duration of the database calls.', ('operation',))
+DB_LOCK_RETRIES = REGISTRY.counter('db_lock_retries_total', 'Database calls retried because the database was locked.',
+                                   ('operation',))
+
+PIPELINE_QUEUE_SIZE = REGISTRY.gauge('bot_pipeline_queue_size', 'Items waiting in the pipeline queues.', ('queue',))
+
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram('telegram_send_seconds', 'Latency of a successful Telegram send.')
+MESSAGES_DELIVERED = REGISTRY.counter('telegram_messages_delivered_total', 'Messages sent to Telegram.')
+MESSAGES_FAILED = REGISTRY.counter('telegram_messages_failed_total', 'Messages that could not be sent to Telegram.')
+DIGESTED_MESSAGES = REGISTRY.counter('telegram_digested_messages_total', 'Messages coalesced into a digest.')
+TELEGRAM_FLOOD_WAITS = REGISTRY.counter('telegram_flood_waits_total', 'RetryAfter errors returned by Telegram.')
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the bot log
+        pass
+
+
+def start_metrics_server(host=MetricsConstants.HOST, port=MetricsConstants.PORT):
+    # Serves /metrics from a daemon thread, so it never blocks the bot's event loop
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,108 @@
+import hashlib
+import re
+import struct
+from collections import deque
+
+from constants import NearDuplicateConstants
+
+URL_PATTERN = re.compile(r'https?://\S+')
+TOKEN_PATTERN = re.compile(r'[\w$%]+(?:[.,][\w%]+)*')
+
+# The fingerprint is a MinHash signature of 64 16-bit values (128 bytes), taken from two 64-byte blake2b digests
+# per shingle. blake2b is used instead of hash() because the fingerprints are stored and hash() changes per process.
+HASHES_PER_DIGEST = 32
+NUM_HASHES = 2 * HASHES_PER_DIGEST
+SIGNATURE = struct.Struct(f'<{NUM_HASHES}H')
+
+
+def normalize(text):
+    # Links are unique per tweet and punctuation like the leading '*' of a repost doesn't change the headline
+    return ' '.join(TOKEN_PATTERN.findall(URL_PATTERN.sub(' ', text).lower()))
+
+
+def get_shingles(text, size=NearDuplicateConstants.SHINGLE_SIZE):
+    text = normalize(text)
+    if not text:
+        return set()
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+
+def fingerprint(text):
+    # MinHash of the character shingles: the share of equal values between two fingerprints estimates the Jaccard
+    # similarity of the texts, which separates short headlines far better than a SimHash of the same size
+    shingles = get_shingles(text)
+    if not shingles:
+        return None
+
+    hash_rows = [SIGNATURE.unpack(hashlib.blake2b(data, digest_size=64, person=b'minhash0').digest() +
+                                  hashlib.blake2b(data, digest_size=64, person=b'minhash1').digest())
+                 for data in (shingle.encode('utf-8') for shingle in shingles)]
+    # Minimum of every column, in one pass in C. zip also covers a single shingle, where map(min, *rows) would
+    # call min on each int of the row
+    return SIGNATURE.pack(*map(min, zip(*hash_rows)))
+
+
+def similarity(fingerprint_a, fingerprint_b):
+    return sum(map(int.__eq__, SIGNATURE.unpack(fingerprint_a), SIGNATURE.unpack(fingerprint_b))) / NUM_HASHES
+
+
+class NearDuplicateIndex:
+    # Locality sensitive index over the fingerprints of the last window seconds. The signature is cut in bands and
+    # two fingerprints become candidates when one whole band is equal, so a lookup only compares against the few
+    # fingerprints sharing a band instead of the whole window. Candidates are then checked with the similarity.
+
+    def __init__(self, window=NearDuplicateConstants.WINDOW, threshold=NearDuplicateConstants.SIMILARITY_THRESHOLD,
+                 bands=NearDuplicateConstants.BANDS):
+        self.window = window
+        self.threshold = threshold
+        self._band_size = NUM_HASHES * 2 // bands
+        self._entries = deque()
+        self._buckets = {}
+        self._latest_timestamp = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_band_keys(self, fingerprint):
+        return [(i, fingerprint[i:i + self._band_size]) for i in range(0, len(fingerprint), self._band_size)]
+
+    def _expire(self):
+        oldest_timestamp = self._latest_timestamp - self.window
+        while self._entries and self._entries[0][0] < oldest_timestamp:
+            _, fingerprint, band_keys = self._entries.popleft()
+            for band_key in band_keys:
+                bucket = self._buckets[band_key]
+                bucket.remove(fingerprint)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def find(self, fingerprint):
+        # Returns the most similar fingerprint in the window above the threshold, or None
+        best_match, best_similarity = None, self.threshold
+        checked = set()
+        for band_key in self._get_band_keys(fingerprint):
+            for candidate in self._buckets.get(band_key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                candidate_similarity = similarity(fingerprint, candidate)
+                if candidate_similarity >= best_similarity:
+                    best_match, best_similarity = candidate, candidate_similarity
+        return best_match
+
+    def add(self, fingerprint, timestamp):
+        self._latest_timestamp = max(self._latest_timestamp, timestamp)
+        band_keys = self._get_band_keys(fingerprint)
+        self._entries.append((timestamp, fingerprint, band_keys))
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, []).append(fingerprint)
+        self._expire()
+
+    def is_near_duplicate(self, fingerprint, timestamp):
+        # Checks the fingerprint against the window and adds it, so a story that keeps being reworded keeps
+        # being recognised as long as every version is close to the previous one
+        self._latest_timestamp = max(self._latest_timestamp, timestamp)
+        self._expire()
+        is_duplicate = self.find(fingerprint) is not None
+        self.add(fingerprint, timestamp)
+        return is_duplicate
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+from constants import BotConstants, PipelineConstants
+from metrics import PIPELINE_QUEUE_SIZE, POLL_STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+async def _get_batch(queue, max_batch_size):
+    # Waits for one item, then takes whatever else is already queued
+    batch = [await queue.get()]
+    while len(batch) < max_batch_size and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+
+class TweetPipeline:
+    # scraper producer -> claimed tweets queue -> matcher -> deliveries queue -> delivery consumer
+    # The producer is the polling job (produce), the matcher and the delivery consumer are tasks of their own, so a
+    # slow Telegram send doesn't hold back the next fetch. The queues are bounded: when a stage falls behind, the
+    # stages before it wait on the full queue instead of piling up work.
+    # A claim marks the tweets as posted, so the pipeline keeps the ids of the claimed tweets until every message
+    # made of them is sent, and stop releases the ones it couldn't send in time. A crash still loses them.
+
+    def __init__(self, scraper, processor, delivery_engine, queue_size=PipelineConstants.QUEUE_SIZE):
+        self.scraper = scraper
+        self.processor = processor
+        self.delivery_engine = delivery_engine
+        self.claimed_tweets = asyncio.Queue(queue_size)
+        self.deliveries = asyncio.Queue(queue_size)
+        self._tasks = []
+        # Claimed tweet ids not sent yet, and message -> [its tweet ids, its deliveries not sent yet]
+        self._unsent_tweet_ids = set()
+        self._unsent_messages = {}
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._run_matcher()), asyncio.ensure_future(self._run_delivery())]
+
+    async def produce(self, usernames, fetch=True):
+        # Fetches and claims the new tweets and queues them for the matcher. Returns the number of new tweets.
+        # With fetch=False the scraper workers store the tweets and only the claimed ones are counted.
+        if fetch:
+            with POLL_STAGE_SECONDS.time(stage='fetch'):
+                new_tweets_per_user = await self.scraper.save_latest_tweets_for_users(usernames)
+        with POLL_STAGE_SECONDS.time(stage='claim'):
+            tweets = await self.scraper.claim_unposted_tweets(usernames)
+        self._unsent_tweet_ids.update(tweet.tweet_id for tweet in tweets)
+        for tweet in tweets:
+            logger.info("Claimed tweet %s of %s", tweet.tweet_id, tweet.author,
+                        extra={'tweet_id': tweet.tweet_id, 'stage': 'claim', 'sampled': True})
+            await self.claimed_tweets.put(tweet)
+        PIPELINE_QUEUE_SIZE.set(self.claimed_tweets.qsize(), queue='claimed_tweets')
+        return sum(new_tweets_per_user.values()) if fetch else len(tweets)
+
+    async def _run_matcher(self):
+        while True:
+            tweets = await _get_batch(self.claimed_tweets, PipelineConstants.MAX_BATCH_SIZE)
+            try:
+                messages_urls_and_keywords = await self.scraper.get_matching_tweet_messages(
+                    tweets, self.processor.keyword_matcher)
+                # The scraper merges the tweets with the same message. The tweets that go to no chat are done.
+                message_to_tweet_ids = {}
+                for tweet in tweets:
+                    message_to_tweet_ids.setdefault(tweet.message.replace('&amp;', '&'), []).append(tweet.tweet_id)
+                messages_and_chat_ids = []
+                for message, url, keywords in messages_urls_and_keywords:
+                    chat_ids = self.processor.keyword_index.get_chat_ids(keywords)
+                    if chat_ids:
+                        self._track_message(str(message), message_to_tweet_ids.pop(message, []), len(chat_ids))
+                    messages_and_chat_ids.append((message, chat_ids))
+                for tweet_ids in message_to_tweet_ids.values():
+                    self._unsent_tweet_ids.difference_update(tweet_ids)
+
+                for message, chat_ids in messages_and_chat_ids:
+                    # One event per message instead of per chat, the sends are logged (sampled) by the delivery
+                    logger.info(BotConstants.IMPORTANT_LOG_MARKER + "|Sending scheduled message: '%s' to chats %s",
+                                message, sorted(chat_ids), extra={'stage': 'match'})
+                    for chat_id in chat_ids:
+                        await self.deliveries.put((chat_id, str(message)))
+                        # await self.delivery_engine.bot.send_photo(chat_id, url, caption=message)  # send photo of google search as well
+            except Exception as e:
+                logger.error("Failed to match %s tweets: %s", len(tweets), e, extra={'stage': 'match'})
+            finally:
+                for _ in tweets:
+                    self.claimed_tweets.task_done()
+                PIPELINE_QUEUE_SIZE.set(self.claimed_tweets.qsize(), queue='claimed_tweets')
+                PIPELINE_QUEUE_SIZE.set(self.deliveries.qsize(), queue='deliveries')
+
+    async def _run_delivery(self):
+        while True:
+            deliveries = await _get_batch(self.deliveries, PipelineConstants.MAX_BATCH_SIZE)
+            try:
+                # Only starts the sends, so one slow chat doesn't hold back the next batch
+                with POLL_STAGE_SECONDS.time(stage='deliver'):
+                    await self.delivery_engine.submit(deliveries, digest_windows=self.processor.chat_digest_windows,
+                                                      on_sent=self._on_message_sent, disable_web_page_preview=True)
+            except Exception as e:
+                logger.error("Failed to deliver %s messages: %s", len(deliveries), e, extra={'stage': 'deliver'})
+            finally:
+                for _ in deliveries:
+                    self.deliveries.task_done()
+                PIPELINE_QUEUE_SIZE.set(self.deliveries.qsize(), queue='deliveries')
+
+    def _track_message(self, message, tweet_ids, deliveries):
+        unsent = self._unsent_messages.setdefault(message, [set(), 0])
+        unsent[0].update(tweet_ids)
+        unsent[1] += deliveries
+
+    def _on_message_sent(self, message):
+        unsent = self._unsent_messages.get(message)
+        if unsent is None:
+            return
+        unsent[1] -= 1
+        if unsent[1] <= 0:
+            del self._unsent_messages[message]
+            self._unsent_tweet_ids.difference_update(unsent[0])
+
+    async def _drain_and_flush(self):
+        await self.drain()
+        await self.delivery_engine.flush_digests()
+
+    async def drain(self):
+        # The claimed tweets first, since matching them adds deliveries
+        await self.claimed_tweets.join()
+        await self.deliveries.join()
+        await self.delivery_engine.wait_until_sent()
+
+    async def stop(self, timeout=PipelineConstants.DRAIN_TIMEOUT):
+        # Sends everything still queued, the pending digests included. What isn't sent within the timeout is
+        # cancelled and its tweets are marked as unposted again, to be claimed after the restart.
+        try:
+            await asyncio.wait_for(self._drain_and_flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping the pipeline with %s tweets and %s messages still queued and %s messages not "
+                           "sent yet", self.claimed_tweets.qsize(), self.deliveries.qsize(),
+                           self.delivery_engine.pending_messages, extra={'stage': 'stop'})
+            self.delivery_engine.cancel_sends()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._unsent_tweet_ids:
+            logger.warning("Releasing %s claimed tweets that weren't sent", len(self._unsent_tweet_ids),
+                           extra={'stage': 'release'})
+            await self.scraper.controller.release_tweets(self._unsent_tweet_ids)
+            self._unsent_tweet_ids.clear()
+            self._unsent_messages.clear()
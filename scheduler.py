@@ -1,4 +1,39 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
+
+from constants import PollingConstants
+
+
+class TimeWindow:
+    # Daily time range with its boundaries precomputed, so checks are integer comparisons
+    # and queries can filter on [start, end) datetimes instead of parsing every row
+
+    __slots__ = ('start_time', 'end_time', '_start_seconds', '_end_seconds')
+
+    def __init__(self, start_time, end_time):
+        self.start_time = start_time
+        self.end_time = end_time
+        self._start_seconds = self._seconds_of_day(start_time)
+        self._end_seconds = self._seconds_of_day(end_time)
+
+    @staticmethod
+    def _seconds_of_day(time_or_datetime):
+        return time_or_datetime.hour * 3600 + time_or_datetime.minute * 60 + time_or_datetime.second
+
+    def contains(self, time_or_datetime):
+        return self._start_seconds <= self._seconds_of_day(time_or_datetime) <= self._end_seconds
+
+    def get_bounds(self, datetime_obj):
+        # The end is exclusive, one second after end_time, since stored dates have second precision
+        day = datetime_obj.replace(hour=0, minute=0, second=0, microsecond=0)
+        return day + timedelta(seconds=self._start_seconds), day + timedelta(seconds=self._end_seconds + 1)
+
+    def get_seconds_until_start(self, datetime_obj):
+        seconds_of_day = self._seconds_of_day(datetime_obj)
+        if self._start_seconds <= seconds_of_day <= self._end_seconds:
+            return 0
+        if seconds_of_day < self._start_seconds:
+            return self._start_seconds - seconds_of_day
+        return 24 * 3600 - seconds_of_day + self._start_seconds
 
 
 class Scheduler:
@@ -8,6 +43,7 @@ class Scheduler:
     # Deployment environment is UTC -> UTC to Sofia time is -3 Hours = 10:00 - 23:30 is 07:00 to 20:30 in UTC
     start_time = datetime.strptime("7:00:00", TIME_FORMAT).time()
     end_time = datetime.strptime("20:30:00", TIME_FORMAT).time()
+    time_window = TimeWindow(start_time, end_time)
 
     @classmethod
     def get_available_zone(cls):
@@ -15,18 +51,43 @@ class Scheduler:
 
     @classmethod
     def is_time_in_range(cls, current_time):
-        return cls.start_time <= current_time <= cls.end_time
+        return cls.time_window.contains(current_time)
 
     @classmethod
     def is_datetime_in_time_range(cls, datetime_obj):
-        date_time_str = datetime_obj.strftime(cls.TIME_FORMAT)
-        time_obj = datetime.strptime(date_time_str, cls.TIME_FORMAT).time()
-        return cls.is_time_in_range(time_obj)
+        return cls.time_window.contains(datetime_obj)
 
     @classmethod
     def is_datetime_from_today(cls, datetime_obj: datetime):
-        current_datetime = datetime.now()
-        return datetime_obj.day == current_datetime.day and datetime_obj.month == current_datetime.month and datetime_obj.year == current_datetime.year
+        return datetime_obj.toordinal() == date.today().toordinal()
+
+    @classmethod
+    def get_time_range_bounds(cls, datetime_obj):
+        return cls.time_window.get_bounds(datetime_obj)
+
+    @classmethod
+    def get_seconds_until_time_range(cls, datetime_obj):
+        return cls.time_window.get_seconds_until_start(datetime_obj)
+
+
+class AdaptivePollingInterval:
+    # Polls fast while the monitored accounts are posting and backs off exponentially while they are idle.
+    # Outside the sharing time range it waits until the range starts again.
+
+    def __init__(self):
+        self.interval = PollingConstants.INITIAL_INTERVAL
+        self.is_enabled = False
+        self.is_polling = False
+
+    def update(self, new_tweets):
+        if new_tweets:
+            self.interval = PollingConstants.MIN_INTERVAL
+        else:
+            self.interval = min(PollingConstants.MAX_INTERVAL, self.interval * PollingConstants.BACKOFF_FACTOR)
+        return self.interval
+
+    def get_next_interval(self, datetime_obj):
+        return max(self.interval, Scheduler.get_seconds_until_time_range(datetime_obj))
 
 
 if __name__ == "__main__":
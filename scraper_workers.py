@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import zlib
+from datetime import datetime
+
+from constants import TwitterAccountsConstants, WorkerConstants
+from db.database_controller import DatabaseController
+from log_pipeline import setup_logging
+from scheduler import AdaptivePollingInterval, Scheduler
+from twitter_scraper import TwitterScraper, initialize_twscrape_api
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(username, worker_count):
+    # crc32 instead of hash(), which changes per process, so a user always lands on the same worker
+    return zlib.crc32(username.lower().encode('utf-8')) % worker_count
+
+
+def shard_usernames(usernames, worker_index, worker_count):
+    return [username for username in usernames if get_shard(username, worker_count) == worker_index]
+
+
+def shard_accounts(accounts, worker_index, worker_count):
+    return accounts[worker_index::worker_count]
+
+
+class ScraperWorkers:
+    # Scraper processes, each fetching the tweets of its shard of the monitored users with its own twitter accounts
+    # into the shared database. The bot process stays the only one claiming and sending the tweets: the inserts
+    # ignore tweets that are already stored and a claim marks the tweets as posted in the same transaction it
+    # reads them, so no tweet is claimed twice. That doesn't make the delivery exactly once: when the pipeline
+    # stops, it releases the tweets that didn't reach all their chats, which get them again after the restart,
+    # and the tweets claimed but not sent when the bot crashes are lost.
+
+    def __init__(self, worker_count):
+        accounts = [account for account in TwitterAccountsConstants.twitter_accounts if account.username]
+        # Two workers sharing an account would only wait on each other's rate limits
+        self.worker_count = max(1, min(worker_count, len(accounts)))
+        self.account_shards = [shard_accounts(accounts, i, self.worker_count) for i in range(self.worker_count)]
+        # spawn, since forking a process with running threads and an event loop isn't safe
+        self._context = multiprocessing.get_context('spawn')
+        self.is_sharing = self._context.Event()
+        self.stop_event = self._context.Event()
+        self.processes = [None] * self.worker_count
+
+    def _start_worker(self, worker_index):
+        process = self._context.Process(
+            target=run_scraper_worker, name=f'scraper-worker-{worker_index}', daemon=True,
+            args=(worker_index, self.worker_count, self.account_shards[worker_index], self.is_sharing,
+                  self.stop_event))
+        process.start()
+        self.processes[worker_index] = process
+
+    def ensure_running(self):
+        # Restarts the workers that died, called on every poll of the bot
+        for worker_index, process in enumerate(self.processes):
+            if self.stop_event.is_set():
+                return
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.error("Scraper worker %s exited with %s, restarting it", worker_index, process.exitcode)
+                self._start_worker(worker_index)
+
+    def set_sharing(self, is_sharing):
+        if is_sharing:
+            self.is_sharing.set()
+        else:
+            self.is_sharing.clear()
+
+    def stop(self, timeout=WorkerConstants.STOP_TIMEOUT):
+        self.stop_event.set()
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Scraper worker %s didn't stop in %ss, terminating it", process.name, timeout)
+                process.terminate()
+                process.join()
+
+
+def run_scraper_worker(worker_index, worker_count, accounts, is_sharing, stop_event):
+    # Ctrl+C reaches the whole process group, the bot stops the workers itself once it has shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A file per worker, since the rollover of a file shared by several processes isn't safe
+    setup_logging(WorkerConstants.LOG_FILE.format(worker_index))
+    asyncio.run(scrape_shard(worker_index, worker_count, accounts, is_sharing, stop_event))
+
+
+async def scrape_shard(worker_index, worker_count, accounts, is_sharing, stop_event):
+    controller = DatabaseController()
+    scraper = TwitterScraper(controller)
+    try:
+        scraper.api = await initialize_twscrape_api(accounts, WorkerConstants.ACCOUNTS_DB.format(worker_index))
+        # Accounts left over from a run with another number of workers belong to another shard now
+        account_usernames = {account.username for account in accounts}
+        other_usernames = [account.username for account in await scraper.api.pool.get_all()
+                           if account.username not in account_usernames]
+        if other_usernames:
+            await scraper.api.pool.delete_accounts(other_usernames)
+        logger.info("Scraper worker %s/%s started with the twitter accounts %s", worker_index + 1, worker_count,
+                    ', '.join(sorted(account_usernames)))
+
+        polling_interval = AdaptivePollingInterval()
+        while not stop_event.is_set():
+            new_tweets = 0
+            if is_sharing.is_set() and Scheduler.is_datetime_in_time_range(datetime.now()):
+                usernames = shard_usernames(await controller.get_monitored_usernames(), worker_index, worker_count)
+                if usernames:
+                    new_tweets_per_user = await scraper.save_latest_tweets_for_users(usernames)
+                    new_tweets = sum(new_tweets_per_user.values())
+            polling_interval.update(new_tweets)
+            await asyncio.to_thread(stop_event.wait, polling_interval.get_next_interval(datetime.now()))
+    finally:
+        await scraper.image_resolver.close()
+        controller.close()
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from constants import DeliveryConstants, DigestConstants
+from metrics import DIGESTED_MESSAGES, MESSAGES_DELIVERED, MESSAGES_FAILED, TELEGRAM_FLOOD_WAITS, \
+    TELEGRAM_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        # rate is in tokens per second
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def is_group_chat(chat_id):
+    # Groups, supergroups and channels have negative ids, private chats positive ones
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return False
+
+
+class ChatDigest:
+    __slots__ = ('texts', 'length', 'flush_handle', 'send_kwargs', 'sent_callbacks')
+
+    SEPARATOR = '\n\n'
+
+    def __init__(self, send_kwargs):
+        self.texts = []
+        self.length = 0
+        self.flush_handle = None
+        self.send_kwargs = send_kwargs
+        self.sent_callbacks = []
+
+    @staticmethod
+    def _get_header(count):
+        return f'{count} new tweets:'
+
+    def get_length_with(self, text):
+        count = len(self.texts) + 1
+        return len(self._get_header(count)) + self.length + len(text) + len(self.SEPARATOR) * count
+
+    def add(self, text, on_sent=None):
+        self.texts.append(text)
+        self.length += len(text)
+        if on_sent is not None:
+            self.sent_callbacks.append((on_sent, text))
+
+    def on_sent(self, _):
+        # The digest is sent, so are all of its texts
+        for on_sent, text in self.sent_callbacks:
+            on_sent(text)
+
+    def format(self):
+        if len(self.texts) == 1:
+            return self.texts[0]
+        return self.SEPARATOR.join([self._get_header(len(self.texts)), *self.texts])
+
+
+class DeliveryEngine:
+    # Sends to all chats concurrently while respecting Telegram's flood limits: a global bucket (~30 msg/s)
+    # and a bucket per chat (~20 msg/min for groups and channels, ~1 msg/s for private chats).
+    # Messages to the same chat are sent in order; a RetryAfter only delays the chat it was raised for.
+    # Chats with a digest window get their messages coalesced into one message per window instead.
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._global_bucket = TokenBucket(DeliveryConstants.GLOBAL_MESSAGES_PER_SECOND,
+                                          DeliveryConstants.GLOBAL_MESSAGES_PER_SECOND)
+        self._chat_buckets = {}
+        self._chat_locks = {}
+        self._semaphore = asyncio.Semaphore(DeliveryConstants.MAX_CONCURRENT_SENDS)
+        self._digests = {}
+        self._send_tasks = set()
+        self.pending_messages = 0
+
+    def _get_chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(DeliveryConstants.GROUP_MESSAGES_PER_MINUTE / 60,
+                                     DeliveryConstants.GROUP_MESSAGES_PER_MINUTE)
+            else:
+                bucket = TokenBucket(DeliveryConstants.PRIVATE_CHAT_MESSAGES_PER_SECOND, 1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send_message(self, chat_id, text, **kwargs):
+        # Returns the latency of the successful send in seconds
+        chat_bucket = self._get_chat_bucket(chat_id)
+        for attempt in range(DeliveryConstants.MAX_RETRY_AFTER_ATTEMPTS + 1):
+            await chat_bucket.acquire()
+            await self._global_bucket.acquire()
+            async with self._semaphore:
+                started_at = time.monotonic()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    latency = time.monotonic() - started_at
+                    TELEGRAM_SEND_SECONDS.observe(latency)
+                    logger.info("Sent message to chat %s", chat_id,
+                                extra={'chat_id': chat_id, 'stage': 'send', 'duration': latency, 'sampled': True})
+                    return latency
+                except RetryAfter as e:
+                    TELEGRAM_FLOOD_WAITS.inc()
+                    if attempt == DeliveryConstants.MAX_RETRY_AFTER_ATTEMPTS:
+                        raise
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+            logger.warning("Flood limit hit for chat %s, retrying in %ss", chat_id, retry_after,
+                           extra={'chat_id': chat_id, 'stage': 'send'})
+            await asyncio.sleep(retry_after)
+
+    async def _send_chat_messages(self, chat_id, texts, on_sent=None, **kwargs):
+        # The texts are counted in pending_messages, which goes down as they are sent
+        # on_sent: called with every text once it is sent or failed, not when the send is cancelled
+        latencies = []
+        failures = 0
+        # Digest flushes and submitted messages run on their own, the lock keeps them in order with the other sends
+        # to the chat
+        chat_lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with chat_lock:
+                for text in texts:
+                    try:
+                        latencies.append(await self.send_message(chat_id, text, **kwargs))
+                    except Exception as e:
+                        failures += 1
+                        logger.error("Failed to send message to chat %s: %s", chat_id, e,
+                                     extra={'chat_id': chat_id, 'stage': 'send'})
+                    self.pending_messages -= 1
+                    if on_sent is not None:
+                        on_sent(text)
+        finally:
+            # Cancelled sends are not pending anymore either
+            self.pending_messages -= len(texts) - len(latencies) - failures
+            MESSAGES_DELIVERED.inc(len(latencies))
+            MESSAGES_FAILED.inc(failures)
+        return latencies, failures
+
+    def _add_to_digest(self, chat_id, text, window, send_kwargs, on_sent):
+        digest = self._digests.get(chat_id)
+        if digest is not None and digest.get_length_with(text) > DigestConstants.MAX_MESSAGE_LENGTH:
+            self._flush_digest(chat_id)
+            digest = None
+        if digest is None:
+            digest = self._digests[chat_id] = ChatDigest(send_kwargs)
+            # The window starts with the first message, so it bounds the delay of every message in the digest
+            digest.flush_handle = asyncio.get_running_loop().call_later(
+                min(window, DigestConstants.MAX_WINDOW), self._flush_digest, chat_id)
+        digest.add(text, on_sent)
+        DIGESTED_MESSAGES.inc()
+
+    def _flush_digest(self, chat_id):
+        digest = self._digests.pop(chat_id, None)
+        if digest is None:
+            return None
+        digest.flush_handle.cancel()
+        return self._start_sending(chat_id, [digest.format()], digest.send_kwargs, digest.on_sent)
+
+    def _start_sending(self, chat_id, texts, send_kwargs, on_sent=None):
+        # Sends in a task of its own, the chat lock keeps the order of the tasks of the same chat
+        self.pending_messages += len(texts)
+        task = asyncio.ensure_future(self._send_chat_messages(chat_id, texts, on_sent, **send_kwargs))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+        return task
+
+    async def flush_digests(self):
+        # Sends all the pending digests now and waits for every message still being sent, e.g. before shutting down
+        tasks = [self._flush_digest(chat_id) for chat_id in list(self._digests)]
+        await asyncio.gather(*self._send_tasks, *tasks)
+
+    async def wait_until_sent(self):
+        # The digests still waiting for their window are not sent. asyncio.wait, unlike gather, leaves the sends
+        # running when the waiting is cancelled.
+        while self._send_tasks:
+            await asyncio.wait(self._send_tasks)
+
+    def cancel_sends(self):
+        # The pending digests are dropped as well
+        for digest in self._digests.values():
+            digest.flush_handle.cancel()
+        self._digests.clear()
+        for task in self._send_tasks:
+            task.cancel()
+
+    def _split_deliveries(self, deliveries, digest_windows, send_kwargs, on_sent=None):
+        # Buffers the messages of the chats with a digest window, returns the other ones grouped by chat
+        chat_id_to_texts = defaultdict(list)
+        for chat_id, text in deliveries:
+            window = digest_windows.get(chat_id) if digest_windows else None
+            if window and len(text) < DigestConstants.MAX_MESSAGE_LENGTH:
+                self._add_to_digest(chat_id, text, window, send_kwargs, on_sent)
+            else:
+                chat_id_to_texts[chat_id].append(text)
+        return chat_id_to_texts
+
+    async def submit(self, deliveries, digest_windows=None, on_sent=None, **kwargs):
+        # deliveries is an iterable of (chat_id, text). digest_windows maps chat ids to their digest window in
+        # seconds; the messages to those chats are buffered and sent as one digest when the window ends or the digest
+        # is full. Returns as soon as the sends are started, so a chat that is rate limited or waiting out a
+        # RetryAfter doesn't hold back the messages to the other chats, and only waits while MAX_PENDING_MESSAGES
+        # are still being sent. on_sent is called with every text once it is sent (or failed), digests included.
+        for chat_id, texts in self._split_deliveries(deliveries, digest_windows, kwargs, on_sent).items():
+            while self._send_tasks and self.pending_messages >= DeliveryConstants.MAX_PENDING_MESSAGES:
+                await asyncio.wait(self._send_tasks, return_when=asyncio.FIRST_COMPLETED)
+            self._start_sending(chat_id, texts, kwargs, on_sent)
+
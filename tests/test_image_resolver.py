@@ -0,0 +1,95 @@
+import asyncio
+
+import httpx
+import pytest
+
+from constants import ImageResolverConstants
+from google.image_resolver import ImageResolver
+
+PAGE = ''.join(f'<img src="/images/{i}.jpg">' for i in range(10)).encode()
+IMAGE_URLS = {f'https://www.google.com/images/{i}.jpg' for i in range(3, 7)}
+
+
+class SearchHandler:
+    # Counts the searches, and holds them until release is set when blocking
+    def __init__(self, blocking=False):
+        self.requests = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        if not blocking:
+            self.release.set()
+
+    async def __call__(self, request):
+        self.requests += 1
+        self.started.set()
+        await self.release.wait()
+        return httpx.Response(200, content=PAGE)
+
+
+def make_resolver(handler):
+    return ImageResolver(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def test_cache_hit():
+    async def run():
+        handler = SearchHandler()
+        resolver = make_resolver(handler)
+        urls = [await resolver.get_random_image('gold') for _ in range(2)]
+        await resolver.close()
+        return handler.requests, urls
+
+    requests, urls = asyncio.run(run())
+    assert requests == 1
+    assert set(urls) <= IMAGE_URLS
+
+
+def test_concurrent_lookups_share_one_search():
+    async def run():
+        handler = SearchHandler(blocking=True)
+        resolver = make_resolver(handler)
+        lookups = asyncio.gather(*[resolver.get_random_image('gold') for _ in range(3)])
+        await handler.started.wait()
+        handler.release.set()
+        urls = await lookups
+        await resolver.close()
+        return handler.requests, urls
+
+    requests, urls = asyncio.run(run())
+    assert requests == 1
+    assert set(urls) <= IMAGE_URLS
+
+
+def test_popular_keywords_are_refreshed_ahead():
+    async def run():
+        handler = SearchHandler()
+        resolver = make_resolver(handler)
+        await resolver.get_random_image('gold')
+        entry = resolver._cache['gold']
+        entry.fetched_at -= ImageResolverConstants.CACHE_TTL * ImageResolverConstants.REFRESH_AHEAD_RATIO + 1
+        for _ in range(ImageResolverConstants.REFRESH_MIN_HITS):
+            await resolver.get_random_image('gold')
+        # Answered from the cache, the refresh runs in the background
+        assert handler.requests == 1
+        await asyncio.gather(*resolver._refresh_tasks)
+        refreshed = resolver._cache['gold'].fetched_at > entry.fetched_at
+        await resolver.close()
+        return handler.requests, refreshed
+
+    requests, refreshed = asyncio.run(run())
+    assert requests == 2
+    assert refreshed
+
+
+def test_close_cancels_the_searches_in_flight():
+    async def run():
+        handler = SearchHandler(blocking=True)
+        resolver = make_resolver(handler)
+        lookup = asyncio.ensure_future(resolver.get_random_image('gold'))
+        await handler.started.wait()
+        download = resolver._in_flight['gold']
+        await resolver.close()
+        with pytest.raises(asyncio.CancelledError):
+            await lookup
+        return download
+
+    assert asyncio.run(run()).cancelled()
@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from db.database_controller import DatabaseController
+from near_duplicates import NUM_HASHES, SIGNATURE, NearDuplicateIndex, fingerprint, similarity
+
+
+def test_fingerprint_of_single_shingle_texts():
+    # Texts of up to SHINGLE_SIZE characters have a single shingle
+    for text in ('$TSLA', 'Gold', 'OIL', '\U0001F6A8 $NVDA'):
+        assert similarity(fingerprint(text), fingerprint(text)) == 1
+
+
+def test_fingerprint_shape():
+    for text in ('Gold', 'Gold prices rise after the CPI print'):
+        tweet_fingerprint = fingerprint(text)
+        assert len(tweet_fingerprint) == SIGNATURE.size
+        assert len(SIGNATURE.unpack(tweet_fingerprint)) == NUM_HASHES
+
+
+def test_fingerprint_of_empty_text():
+    assert fingerprint('') is None
+    assert fingerprint('https://t.co/abc') is None
+
+
+def test_short_tweets_are_near_duplicates_of_themselves():
+    index = NearDuplicateIndex()
+    assert not index.is_near_duplicate(fingerprint('$TSLA'), 100)
+    assert index.is_near_duplicate(fingerprint('*$TSLA'), 101)
+
+
+def test_insert_short_tweets(tmp_path, monkeypatch):
+    monkeypatch.setattr(DatabaseController, 'DB_NAME', str(tmp_path / 'data' / 'test.db'))
+    controller = DatabaseController()
+    tweets = [SimpleNamespace(id=i, date=datetime.now(), rawContent=text, user=SimpleNamespace(username='user'))
+              for i, text in enumerate(['$TSLA', 'OIL', 'Gold prices rise'], start=1)]
+    try:
+        assert asyncio.run(controller.insert_tweets(tweets, author='user')) == 3
+        assert asyncio.run(controller.get_last_tweet_id('user')) == 3
+        stored = controller.engine.read_sync(lambda conn: conn.execute(
+            'SELECT fingerprint FROM tweets WHERE message = ?', ('$TSLA',)).fetchone()[0])
+        assert stored == fingerprint('$TSLA')
+    finally:
+        controller.close()
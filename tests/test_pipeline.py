@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from benchmarks.fakes import make_image_search_client
+from db.database_controller import DatabaseController
+from google.image_resolver import ImageResolver
+from keyword_matcher import KeywordMatcher
+from pipeline import TweetPipeline
+from scheduler import Scheduler
+from telegram_delivery import DeliveryEngine
+from twitter_scraper import TwitterScraper
+
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = {}
+        self.private_sent = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        self.sent.setdefault(chat_id, []).append(text)
+        if chat_id > 0:
+            self.private_sent.set()
+
+
+def test_rate_limited_group_does_not_delay_other_chats():
+    async def run():
+        bot = RecordingBot()
+        pipeline = TweetPipeline(None, SimpleNamespace(chat_digest_windows={}), DeliveryEngine(bot))
+        pipeline.start()
+        # More than the 20 messages per minute of a group
+        for i in range(23):
+            await pipeline.deliveries.put((-100, f'group message {i}'))
+        await pipeline.deliveries.put((42, 'private message'))
+        await bot.private_sent.wait()
+        # Waiting behind the group would mean waiting for the bucket to refill for the 3 last group messages
+        group_sent_before_private = len(bot.sent.get(-100, []))
+        await pipeline.stop(timeout=0)
+        return bot.sent, group_sent_before_private
+
+    sent, group_sent_before_private = asyncio.run(run())
+    assert sent[42] == ['private message']
+    assert group_sent_before_private <= 20
+    assert len(sent[-100]) <= 20
+
+
+class BlockingBot:
+    # Sends to the private chat right away, the sends to the group never finish
+    def __init__(self):
+        self.sent = []
+        self.private_sent = asyncio.Event()
+        self.group_started = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id < 0:
+            self.group_started.set()
+            await asyncio.Event().wait()
+        self.sent.append((chat_id, text))
+        self.private_sent.set()
+
+
+def test_stop_releases_the_tweets_it_could_not_send(tmp_path, monkeypatch):
+    monkeypatch.setattr(DatabaseController, 'DB_NAME', str(tmp_path / 'data' / 'test.db'))
+    monkeypatch.setattr(Scheduler, 'get_time_range_bounds', lambda datetime_obj: (None, None))
+    keyword_to_chat_id = {'gold': 42, 'oil': -100, 'silver': 7}
+    processor = SimpleNamespace(
+        keyword_matcher=KeywordMatcher(keyword_to_chat_id),
+        keyword_index=SimpleNamespace(get_chat_ids=lambda keywords: {keyword_to_chat_id[k] for k in keywords}),
+        # The digest of chat 7 is still waiting for its window when the pipeline stops
+        chat_digest_windows={7: 60})
+    controller = DatabaseController()
+
+    async def run():
+        bot = BlockingBot()
+        scraper = TwitterScraper(controller)
+        scraper.image_resolver = ImageResolver(client=make_image_search_client())
+        pipeline = TweetPipeline(scraper, processor, DeliveryEngine(bot))
+        now = datetime.now()
+        user = SimpleNamespace(username='user')
+        await controller.insert_tweets([SimpleNamespace(id=tweet_id, date=now, rawContent=text, user=user)
+                                        for tweet_id, text in [(1, 'gold rises'), (2, 'oil falls'),
+                                                               (3, 'nothing new'), (4, 'silver shines')]])
+        pipeline.start()
+        assert await pipeline.produce(['user'], fetch=False) == 4
+        await bot.private_sent.wait()
+        await bot.group_started.wait()
+        await pipeline.stop(timeout=0)
+        await scraper.image_resolver.close()
+        return bot.sent, await controller.claim_today_unposted_tweets(['user'])
+
+    try:
+        sent, reclaimed = asyncio.run(run())
+    finally:
+        controller.close()
+    assert sent == [(42, 'gold rises')]
+    assert [tweet.tweet_id for tweet in reclaimed] == [2, 4]
@@ -0,0 +1,36 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import tweet_archive
+from constants import DatabaseConstants
+from db.database_controller import DatabaseController
+from db.migrations import is_incremental_auto_vacuum_enabled
+
+
+def test_old_imported_tweets_survive_the_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(DatabaseController, 'DB_NAME', str(tmp_path / 'data' / 'test.db'))
+    controller = DatabaseController()
+    now = int(time.time())
+    old_date = now - (DatabaseConstants.RETENTION_DAYS + 10) * 24 * 60 * 60
+    try:
+        imported = controller.import_tweet_batches([[(1, old_date, 'old gold', 'user'), (2, now, 'new gold', 'user')]])
+        assert imported == 2
+        cutoff = datetime.now() - timedelta(days=DatabaseConstants.RETENTION_DAYS)
+        assert asyncio.run(controller.prune_tweets_older_than(cutoff)) == 0
+        assert [tweet.tweet_id for tweet in controller.iterate_tweets()] == [2, 1]
+    finally:
+        controller.close()
+
+
+def test_vacuum_enables_incremental_vacuum_once(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(DatabaseController, 'DB_NAME', str(tmp_path / 'data' / 'test.db'))
+    controller = DatabaseController()
+    try:
+        assert not controller.engine.read_sync(is_incremental_auto_vacuum_enabled)
+    finally:
+        controller.close()
+
+    assert tweet_archive.main(['vacuum']) == 0
+    assert tweet_archive.main(['vacuum']) == 0
+    assert capsys.readouterr().out.splitlines()[1] == "Incremental vacuum is already enabled"
@@ -0,0 +1,159 @@
+import argparse
+import gzip
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+
+from constants import BotConstants, DatabaseConstants
+from db.database_controller import DatabaseController
+from keyword_matcher import KeywordMatcher
+
+
+def open_archive(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def parse_date(value):
+    # Epoch seconds or an ISO 8601 string (twscrape writes "2023-10-05T12:00:00+00:00")
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+
+def parse_tweet_line(line):
+    # Accepts the twscrape Tweet json (id, date, rawContent, user.username) and flat rows
+    # (tweet_id, date, message, author) as they are stored in the tweets table
+    tweet = json.loads(line)
+    user = tweet.get('user') or {}
+    return (
+        int(tweet.get('tweet_id') or tweet['id']),
+        parse_date(tweet['date']),
+        tweet.get('message') or tweet.get('rawContent') or tweet.get('text') or '',
+        tweet.get('author') or user.get('username'),
+    )
+
+
+def read_tweet_rows(file, stats):
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_tweet_line(line)
+        except (ValueError, KeyError, TypeError) as e:
+            stats['skipped'] += 1
+            print(f"Skipping line {line_number}: {e}", file=sys.stderr)
+
+
+def batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def import_archive(controller, path, batch_size):
+    stats = Counter()
+    started_at = time.perf_counter()
+
+    def count_batches(batches):
+        for batch in batches:
+            stats['read'] += len(batch)
+            stats['batches'] += 1
+            if stats['batches'] % 20 == 0:
+                print(f"Read {stats['read']} tweets...", file=sys.stderr)
+            yield batch
+
+    with open_archive(path) as file:
+        imported = controller.import_tweet_batches(count_batches(batched(read_tweet_rows(file, stats), batch_size)))
+
+    elapsed = time.perf_counter() - started_at
+    print(f"Imported {imported} new tweets out of {stats['read']} read ({stats['skipped']} unreadable lines skipped) "
+          f"in {elapsed:.1f}s, {stats['read'] / elapsed if elapsed else 0:.0f} tweets/s")
+
+
+def get_bot_keywords(controller):
+    state = controller.load_bot_state()
+    keywords = set(state.filter_keywords)
+    for chat_keywords in state.chat_filter_keywords.values():
+        keywords.update(chat_keywords)
+    return keywords
+
+
+def replay_keywords(controller, keywords, start, end, authors, batch_size):
+    # Runs the stored tweets through the same matching as the bot, without claiming or sending anything
+    matcher = KeywordMatcher(keywords, case_insensitive=BotConstants.KEYWORDS_CASE_INSENSITIVE,
+                             whole_word=BotConstants.KEYWORDS_WHOLE_WORD)
+    hits = Counter()
+    scanned = matched = 0
+    for tweet in controller.iterate_tweets(start, end, authors, batch_size):
+        scanned += 1
+        matching_keywords = set(matcher.find(tweet.message.replace('&amp;', '&')))
+        if matching_keywords:
+            matched += 1
+            hits.update(matching_keywords)
+
+    print(f"Scanned {scanned} tweets, {matched} matched at least one keyword")
+    for keyword in sorted(keywords, key=lambda keyword: (-hits[keyword], keyword)):
+        print(f"{hits[keyword]:>10}  {keyword}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import of tweet archives, keyword replay over the stored '
+                                                 'tweets and database maintenance.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='stream a JSONL tweet archive (.jsonl, .jsonl.gz or - for '
+                                                         'stdin) as already posted tweets, the ones older than the '
+                                                         'retention go to tweets_archive')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--batch-size', type=int, default=DatabaseConstants.IMPORT_BATCH_SIZE)
+
+    replay_parser = subparsers.add_parser('replay', help='count the stored tweets each keyword would have matched')
+    replay_parser.add_argument('--keywords', nargs='+', help="defaults to the bot's and the chats' keywords")
+    replay_parser.add_argument('--since', type=datetime.fromisoformat, help='local date or datetime, inclusive')
+    replay_parser.add_argument('--until', type=datetime.fromisoformat, help='local date or datetime, exclusive')
+    replay_parser.add_argument('--authors', nargs='+', help='only the tweets of these users (without @)')
+    replay_parser.add_argument('--batch-size', type=int, default=DatabaseConstants.REPLAY_BATCH_SIZE)
+
+    subparsers.add_parser('vacuum', help='enable incremental vacuum once, with a full VACUUM that rewrites the '
+                                         'database file (stop the bot first)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    controller = DatabaseController()
+    try:
+        if args.command == 'import':
+            import_archive(controller, args.path, args.batch_size)
+        elif args.command == 'vacuum':
+            started_at = time.perf_counter()
+            if controller.enable_incremental_auto_vacuum():
+                print(f"Enabled incremental vacuum in {time.perf_counter() - started_at:.1f}s")
+            else:
+                print("Incremental vacuum is already enabled")
+        else:
+            keywords = args.keywords or get_bot_keywords(controller)
+            if not keywords:
+                print("No keywords to replay, pass them with --keywords")
+                return 1
+            replay_keywords(controller, keywords, args.since, args.until, args.authors, args.batch_size)
+    finally:
+        controller.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# To use it run from the project directory:
+# python tweet_archive.py import tweets.jsonl.gz
+# python tweet_archive.py replay --keywords '$TSLA' 'Gold' --since 2024-01-01 --until 2024-02-01
+# python tweet_archive.py vacuum
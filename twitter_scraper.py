@@ -1,118 +1,204 @@
-import json
 import asyncio
+import logging
 from collections import defaultdict
-from datetime import datetime
+from contextlib import aclosing
+from datetime import datetime, timedelta
 
-from twscrape import API, gather
-from twscrape.logger import set_log_level
+from twscrape import API
 
-from constants import ScraperConstants, TwitterAccountsConstants
+from account_pool import HealthAwareAccountsPool
+from constants import AccountPoolConstants, NearDuplicateConstants, ScraperConstants, TwitterAccountsConstants
 from db.database_controller import DatabaseController
-from google.google_search import get_random_google_image
+from google.image_resolver import ImageResolver
+from keyword_matcher import KeywordMatcher
+from metrics import POLL_STAGE_SECONDS, TWEET_FETCH_ERRORS, TWEET_FETCH_SECONDS, TWEETS_INGESTED, TWEETS_MATCHED, \
+    TWEETS_SUPPRESSED
+from near_duplicates import NearDuplicateIndex, fingerprint
 from scheduler import Scheduler
 
-set_log_level("DEBUG")
+logger = logging.getLogger(__name__)
 
 
 class TwitterScraper:
-    user_dict = None
     api = None
 
-    def __init__(self):
-        self._load_user_dict()
-        self.controller = DatabaseController()
-
-    def save_monitored_user(self, data_json):
-        try:
-            with open(ScraperConstants.MONITORED_USER_DATA_FILE, 'w') as file:
-                json.dump(data_json, file)
-            return True
-        except Exception as e:
-            print(f"Error saving dictionary to file: {e}")
-            return False
-
-    def _load_user_dict(self):
-        try:
-            with open(ScraperConstants.MONITORED_USER_DATA_FILE, 'r') as file:
-                data_dict = json.load(file)
-            user_dict = json.loads(data_dict)
-        except FileNotFoundError:
-            print(f"File '{ScraperConstants.MONITORED_USER_DATA_FILE}' not found.")
-            user_dict = None
-        except Exception as e:
-            print(f"Error reading dictionary from file: {e}")
-            user_dict = None
-        self.user_dict = user_dict
+    def __init__(self, controller=None):
+        self.controller = controller or DatabaseController()
+        self.image_resolver = ImageResolver()
+        self.user_ids = {}
+        self.near_duplicate_index = None
+        self._api_lock = asyncio.Lock()
+
+    async def initialize(self, usernames=()):
+        # Called at startup, so the first poll doesn't pay for the logins and the user lookups
+        await self._ensure_api()
+        await asyncio.gather(*[self.get_user_id(username) for username in usernames], return_exceptions=True)
+
+    async def _ensure_api(self):
+        async with self._api_lock:
+            if self.api is None:
+                self.api = await initialize_twscrape_api()
+        return self.api
+
+    async def get_user_id(self, username):
+        user_id = self.user_ids.get(username.lower())
+        if user_id is None:
+            user_id = await self.controller.get_cached_user_id(username, ScraperConstants.USER_ID_CACHE_TTL)
+        if user_id is None:
+            user_id = await self.reset_user(username)
+        self.user_ids[username.lower()] = user_id
+        return user_id
 
     async def reset_user(self, username):
-        user = None
-        for i in range(10):
+        await self._ensure_api()
+        for attempt in range(ScraperConstants.RESOLVE_USER_ATTEMPTS):
             user = await self.api.user_by_login(username)
             if user is not None:
-                break
-
-        self.user_dict = user.dict()
-        self.save_monitored_user(user.json())
+                await self.controller.save_user_id(username, user.id)
+                return user.id
+            await asyncio.sleep(ScraperConstants.RESOLVE_USER_RETRY_DELAY * (2 ** attempt))
+        raise ValueError(f"Could not resolve the twitter user '{username}'")
 
     async def save_latest_tweets(self, username):
-        if self.api is None:
-            self.api = await initialize_twscrape_api()
-
-        if not self.user_dict or self.user_dict.get('username') != username:
-            await self.reset_user(username)
-
-        tweets = await gather(self.api.user_tweets(self.user_dict['id'], limit=10))
-        tweets = sorted(tweets, key=lambda tweet: tweet.date, reverse=True)
-
-        for tweet in tweets:
-            await self.controller.insert_tweet(tweet)
-
-    async def get_unposed_tweet_messages_and_mark_the_tweets_as_posted(self, username, keywords):
-        important_message_to_keywords = defaultdict(list)
-
-        tweets = await self.controller.retrieve_today_unposted_tweets(username)
-
-        for tweet in tweets:
-            await self.controller.mark_tweet_as_posted(tweet.tweet_id)
-
-            tweet_datetime = datetime.strptime(tweet.date, self.controller.DATETIME_FORMAT)
-            if not Scheduler.is_datetime_from_today(tweet_datetime) \
-                    or not Scheduler.is_datetime_in_time_range(tweet_datetime):
+        await self._ensure_api()
+        with TWEET_FETCH_SECONDS.time():
+            user_id = await self.get_user_id(username)
+            last_tweet_id = await self.controller.get_last_tweet_id(username)
+            tweets = await self._fetch_new_tweets(user_id, last_tweet_id)
+            new_tweets = await self.controller.insert_tweets(tweets, author=username)
+        TWEETS_INGESTED.inc(new_tweets)
+        return new_tweets
+
+    async def save_latest_tweets_for_users(self, usernames):
+        # Fetches all users concurrently, so a cycle takes about as long as the slowest user.
+        # Returns the number of new tweets per user (users whose fetch failed are left out).
+        await self._ensure_api()
+        if self.api.pool.is_circuit_open(AccountPoolConstants.TIMELINE_QUEUE):
+            logger.warning("Skipping the fetch, all the twitter accounts are rate limited", extra={'stage': 'fetch'})
+            return {}
+
+        semaphore = asyncio.Semaphore(await self._get_fetch_concurrency(len(usernames)))
+
+        async def save_latest_tweets_with_limit(username):
+            async with semaphore:
+                return await self.save_latest_tweets(username)
+
+        results = await asyncio.gather(*[save_latest_tweets_with_limit(username) for username in usernames],
+                                       return_exceptions=True)
+
+        new_tweets_per_user = {}
+        for username, result in zip(usernames, results):
+            if isinstance(result, Exception):
+                TWEET_FETCH_ERRORS.inc()
+                logger.error("Error fetching the latest tweets of %s: %s", username, result, extra={'stage': 'fetch'})
                 continue
+            new_tweets_per_user[username] = result
+        return new_tweets_per_user
+
+    async def _get_fetch_concurrency(self, number_of_users):
+        # twscrape locks an account per queue while a request is running, so more concurrent timeline
+        # fetches than active accounts would only wait for one to free up
+        accounts = await self.api.pool.get_all()
+        active_accounts = sum(1 for account in accounts if account.active)
+        concurrency = active_accounts * ScraperConstants.CONCURRENT_FETCHES_PER_ACCOUNT
+        return max(1, min(number_of_users, concurrency))
+
+    async def _fetch_new_tweets(self, user_id, last_tweet_id):
+        # The timeline is newest first and paged lazily, so stop as soon as it reaches tweets we already have
+        # and keep paging while everything is new (bursts)
+        if last_tweet_id is None:
+            limit = ScraperConstants.FIRST_FETCH_LIMIT
+        else:
+            limit = ScraperConstants.MAX_NEW_TWEETS_PER_FETCH
+
+        new_tweets = []
+        known_tweets_in_a_row = 0
+        async with aclosing(self.api.user_tweets(user_id, limit=limit)) as timeline:
+            async for tweet in timeline:
+                if last_tweet_id is not None and tweet.id <= last_tweet_id:
+                    known_tweets_in_a_row += 1
+                    if known_tweets_in_a_row >= ScraperConstants.KNOWN_TWEETS_BEFORE_STOP:
+                        break
+                    continue
+
+                known_tweets_in_a_row = 0
+                new_tweets.append(tweet)
+                if len(new_tweets) >= limit:
+                    break
+        return new_tweets
+
+    async def get_unposed_tweet_messages_and_mark_the_tweets_as_posted(self, usernames, keyword_matcher):
+        tweets = await self.claim_unposted_tweets(usernames)
+        return await self.get_matching_tweet_messages(tweets, keyword_matcher)
+
+    async def claim_unposted_tweets(self, usernames):
+        window_start, window_end = Scheduler.get_time_range_bounds(datetime.now())
+        if self.near_duplicate_index is None:
+            await self._load_near_duplicate_index(usernames, window_start, window_end)
+        return await self.controller.claim_today_unposted_tweets(usernames, window_start, window_end)
+
+    async def get_matching_tweet_messages(self, tweets, keyword_matcher):
+        # Returns (message, image url, matching keywords) for the tweets that match, near-duplicates left out
+        important_message_to_keywords = defaultdict(list)
 
-            message = tweet.message
-            message = message.replace('&amp;', '&')
-            for keyword in keywords:
-                if keyword in message:
-                    matching_keywords = important_message_to_keywords[message]
-                    matching_keywords.append(keyword)
-
-        list_of_messages_and_google_urls = []
-        for message, keywords in important_message_to_keywords.items():
-            google_url = get_random_google_image(keywords[0])
-            list_of_messages_and_google_urls.append((message, google_url))
-
-        return list_of_messages_and_google_urls
+        with POLL_STAGE_SECONDS.time(stage='keyword_match'):
+            for tweet in tweets:
+                if self._is_near_duplicate(tweet):
+                    TWEETS_SUPPRESSED.inc()
+                    continue
+
+                message = tweet.message
+                message = message.replace('&amp;', '&')
+                matching_keywords = keyword_matcher.find(message)
+                if matching_keywords:
+                    TWEETS_MATCHED.inc()
+                    important_message_to_keywords[message].extend(matching_keywords)
+
+        google_urls = await asyncio.gather(*[self.image_resolver.get_random_image(keywords[0])
+                                             for keywords in important_message_to_keywords.values()])
+        return [(message, google_url, keywords)
+                for (message, keywords), google_url in zip(important_message_to_keywords.items(), google_urls)]
+
+    async def _load_near_duplicate_index(self, usernames, window_start, window_end):
+        # After a restart, the tweets claimed in the last window still count
+        self.near_duplicate_index = NearDuplicateIndex()
+        since = datetime.now() - timedelta(seconds=NearDuplicateConstants.WINDOW)
+        for date, tweet_fingerprint in await self.controller.get_claimed_fingerprints(usernames, since, window_start,
+                                                                                      window_end):
+            self.near_duplicate_index.add(tweet_fingerprint, date)
+
+    def _is_near_duplicate(self, tweet):
+        # Tweets stored before the fingerprints existed don't have one
+        tweet_fingerprint = tweet.fingerprint or fingerprint(tweet.message)
+        if tweet_fingerprint is None:
+            return False
+        return self.near_duplicate_index.is_near_duplicate(tweet_fingerprint, tweet.date)
 
 
-async def initialize_twscrape_api():
-    api = API()
+async def initialize_twscrape_api(accounts=TwitterAccountsConstants.twitter_accounts, db_file='accounts.db'):
+    # Sessions are persisted by twscrape in accounts.db, so only accounts that are new or lost their session log in,
+    # and those log in concurrently
+    api = API(HealthAwareAccountsPool(db_file))
 
-    for account in TwitterAccountsConstants.twitter_accounts:
-        if account.username:
+    existing_usernames = {account.username for account in await api.pool.get_all()}
+    for account in accounts:
+        if account.username and account.username not in existing_usernames:
             await api.pool.add_account(account.username, account.password, account.email, account.email_password)
-    await api.pool.login_all()
+
+    stale_accounts = [account for account in await api.pool.get_all() if not account.active and not account.error_msg]
+    await asyncio.gather(*[api.pool.login(account) for account in stale_accounts])
     return api
 
 
 if __name__ == "__main__":
     async def main():
         scraper = TwitterScraper()
-        test_username = 'DeItaone'
-        await scraper.save_latest_tweets(test_username)
-        messages_and_urls = await scraper.get_unposed_tweet_messages_and_mark_the_tweets_as_posted(
-            test_username, ['$TSLA', 'Gold', '$AAPL', 'OIL', '$AMZN', '$INTC']
+        test_usernames = ['DeItaone']
+        await scraper.save_latest_tweets_for_users(test_usernames)
+        messages_urls_and_keywords = await scraper.get_unposed_tweet_messages_and_mark_the_tweets_as_posted(
+            test_usernames, KeywordMatcher(['$TSLA', 'Gold', '$AAPL', 'OIL', '$AMZN', '$INTC'])
         )
-        print(messages_and_urls)
+        print(messages_urls_and_keywords)
+        await scraper.image_resolver.close()
 
     asyncio.run(main())
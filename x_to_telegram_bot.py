@@ -1,47 +1,41 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
 import os
 import logging
 import sys
 import re
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from telegram.ext import Application, CommandHandler, ContextTypes
 from telegram import Update
 from bot_data_processor import BotDataProcessor
-from constants import BotConstants
-from scheduler import Scheduler
+from constants import BotConstants, DatabaseConstants, DigestConstants, WorkerConstants
+from db.database_controller import DatabaseController
+import log_pipeline
+from metrics import LAST_POLL_CYCLE_TIMESTAMP, MONITORED_USERS, POLL_CYCLE_SECONDS, POLL_INTERVAL_SECONDS, \
+    SUBSCRIBED_CHATS, start_metrics_server
+from pipeline import TweetPipeline
+from scheduler import AdaptivePollingInterval, Scheduler
+from scraper_workers import ScraperWorkers
+from telegram_delivery import DeliveryEngine
 from twitter_scraper import TwitterScraper
 
 
-def setup_logging(log_directory='log'):
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
-
-    log_file_path = os.path.join(log_directory, 'bot.log')
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file_path, 'a', 'utf-8'),
-            logging.StreamHandler(),
-        ],
-        datefmt='%m/%d/%Y %I:%M:%S %p',
-    )
-
-    logger = logging.getLogger(BotConstants.BOT_NAME)
-    for handler in logger.handlers:
-        if isinstance(handler, logging.FileHandler):
-            handler.flush()
-    return logger
+def setup_logging():
+    log_pipeline.setup_logging('bot.log')
+    return logging.getLogger(BotConstants.BOT_NAME)
 
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_currently_sharing = update.message.chat_id in context.application.injected_bot_data_processor.subscribed_chat_ids
     current_configuration = f"""
 Current configuration:
-    Monitoring: @{context.application.injected_bot_data_processor.get_formatted_monitored_username()}
+    Monitoring: {', '.join(f'@{username}' for username in context.application.injected_bot_data_processor.get_formatted_monitored_usernames())}
     Keywords: {context.application.injected_bot_data_processor.get_formatted_keywords()}
+    Keywords for current chat: {context.application.injected_bot_data_processor.get_formatted_chat_keywords(update.message.chat_id)}
+    Digest window for current chat: {context.application.injected_bot_data_processor.chat_digest_windows.get(update.message.chat_id, 'off')}
     Sharing {'disabled' if not is_currently_sharing else 'enabled'} for current chat.
     {f'Sharing enabled for chats {context.application.injected_bot_data_processor.get_formatted_subscribed_chat_ids()}' 
     if context.application.injected_bot_data_processor.subscribed_chat_ids else ''}
@@ -55,8 +49,11 @@ Quickstart:
 1. To set the keywords that you want to match in the latest tweets use:
 /set_keywords - '$NVDA' '$TSLA' '$AMZN' '$APPL' '$NIO' '$MSFT' '$NFLX' '$META' 'Gold' 'Silver' 'NASDAQ' 'S&P 500' 'OIL' - <bot normal command password>
 
-2. To monitor an individual twitter user use:
-/monitor @DeItaone <bot normal command password>
+1.1. To use different keywords in a chat or channel than the ones above (no keywords resets it to the ones above):
+/set_chat_keywords <optional channel id> - '$NVDA' 'Gold' - <bot normal command password>
+
+2. To monitor one or more twitter users use:
+/monitor @DeItaone @FirstSquawk <bot normal command password>
 
 # Choose chat or channel
 3.1. To officially make the bot start posting the new tweets to your chat:
@@ -79,6 +76,12 @@ If you are annoyed or want to stop the sharing of tweets
 - For channels send this command to the bot privately (using the channel id that you get. It will not start notifying until correct password is received when you forwarded the /post_to_channel message)
 /stop_sharing_to_channel <channel id> <bot sharing password>
 
+To get the tweets of a window of seconds together in one message instead of one message per tweet (0 turns it off):
+/set_digest <optional channel id> 60 <bot normal command password>
+
+To see the rate limits and health of the twitter accounts:
+/status <bot normal command password>
+
 """ + current_configuration)
 
 
@@ -93,7 +96,7 @@ async def set_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pattern = r"'([^']*)'"
         keywords = re.findall(pattern, text.split('-')[1])
-        print(keywords)
+        logger.debug("Parsed the keywords %s", keywords)
     except Exception as e:
         logger.error(f"{BotConstants.IMPORTANT_LOG_MARKER}| Failed to change the bot keywords. Reason: '{str(e)}'."
                      f"Command issued by {str(update.effective_user)}")
@@ -111,56 +114,139 @@ async def set_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"/set_keywords <bot normal command password> {BotConstants.BOT_NAME} - '$TSLA' 'gold' 'S&P")
 
 
+async def set_chat_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    if not await validate_args_and_password_for_normal_command(chat_id, update, context):
+        return
+
+    processor = context.application.injected_bot_data_processor
+    target_chat_id = chat_id
+    if context.args[0].lstrip('-').isdigit() and len(context.args) > 1:
+        # Channel id passed explicitly, same as /start_sharing_on_channel
+        target_chat_id = context.args[0]
+
+    pattern = r"'([^']*)'"
+    keywords = re.findall(pattern, update.message.text)
+
+    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}| Changing the keywords of chat {str(target_chat_id)} to: "
+                f"'{str(keywords)}'. Command issued by {str(update.effective_user)}")
+    processor.set_chat_filter_keywords(target_chat_id, keywords)
+    if keywords:
+        await update.message.reply_text(f"Successfully updated the keywords of chat {target_chat_id} to be {keywords}")
+    else:
+        await update.message.reply_text(f"Chat {target_chat_id} now uses the bot keywords "
+                                        f"{processor.get_formatted_keywords()}")
+
+
+async def set_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    if not await validate_args_and_password_for_normal_command(chat_id, update, context, min_required_args=2):
+        return
+
+    processor = context.application.injected_bot_data_processor
+    target_chat_id = chat_id
+    if len(context.args) > 2:
+        # Channel id passed explicitly, same as /start_sharing_on_channel
+        target_chat_id = context.args[0]
+
+    window = context.args[-2]
+    if not window.isdigit():
+        return await update.message.reply_text("The digest window needs to be a number of seconds. "
+                                               "e.g: \n/set_digest 60 <bot normal command password>")
+    window = min(int(window), DigestConstants.MAX_WINDOW)
+
+    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}| Changing the digest window of chat {str(target_chat_id)} to "
+                f"{window}s. Command issued by {str(update.effective_user)}")
+    processor.set_chat_digest_window(target_chat_id, window)
+    if window:
+        await update.message.reply_text(f"Chat {target_chat_id} now gets the matching tweets of every {window} "
+                                        f"seconds in one message")
+    else:
+        await update.message.reply_text(f"Chat {target_chat_id} now gets every matching tweet in its own message")
+
+
 async def monitor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message or update.edited_message or update.channel_post or update.edited_channel_post or (update.callback_query.message if update.callback_query else None)
     if not message:
         logger.error("Could not find message to reply to.")
 
     chat_id = message.chat_id
-    if not await validate_args_and_password_for_normal_command(chat_id, update, context, num_required_args=2):
+    if not await validate_args_and_password_for_normal_command(chat_id, update, context, min_required_args=2):
         return
 
     processor = context.application.injected_bot_data_processor
-    twitter_user = context.args[-2]
+    twitter_users = context.args[:-1]
 
-    if not twitter_user or not str(twitter_user).startswith('@'):
-        logger.error(f"{BotConstants.IMPORTANT_LOG_MARKER}| Failed to change the person to monitor. "
-                     f"The twitter user needs to start with @."
+    if not all(str(twitter_user).startswith('@') and len(twitter_user) > 1 for twitter_user in twitter_users):
+        logger.error(f"{BotConstants.IMPORTANT_LOG_MARKER}| Failed to change the people to monitor. "
+                     f"The twitter users need to start with @."
                      f"Command issued by {str(update.effective_user)}")
 
-        return await message.reply_text(f"The commands need to have a @user and password."
-                                               f"e.g. /monitor {BotConstants.BOT_NAME} @DeItaone <bot normal command password>")
+        return await message.reply_text(f"The commands need to have one or more @users and password."
+                                        f"e.g. /monitor {BotConstants.BOT_NAME} @DeItaone @FirstSquawk <bot normal command password>")
+
+    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}| Changing the people to monitor to: '{str(twitter_users)}'. "
+                f"Command issued by {str(update.effective_user)}")
+    processor.set_monitored_users(twitter_users)
+    await message.reply_text(f"Successfully started monitoring the users {', '.join(twitter_users)}.")
+
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    if not await validate_args_and_password_for_normal_command(chat_id, update, context, num_required_args=1):
+        return
+
+    if context.application.injected_scraper_workers:
+        return await update.message.reply_text("The twitter accounts are used by the scraper workers, "
+                                               "see their logs.")
+
+    api = context.application.injected_scraper.api
+    if api is None:
+        return await update.message.reply_text("The twitter accounts are not logged in yet.")
 
-    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}| Changing the person to monitor to: '{str(twitter_user)}'. "
+    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}|Sending the twitter accounts status. "
                 f"Command issued by {str(update.effective_user)}")
-    processor.set_monitored_user(twitter_user)
-    await message.reply_text(f"Successfully started monitoring the user {twitter_user}.")
+    await update.message.reply_text("Twitter accounts:\n" + '\n'.join(await api.pool.get_status()))
 
 
 async def send_scheduled_message(context: ContextTypes.DEFAULT_TYPE):
+    polling_interval = context.application.injected_polling_interval
+    if polling_interval.is_polling:
+        return
+
+    polling_interval.is_polling = True
+    new_tweets = 0
+    try:
+        with POLL_CYCLE_SECONDS.time():
+            new_tweets = await poll_and_send_messages(context)
+    finally:
+        polling_interval.is_polling = False
+        polling_interval.update(new_tweets)
+        LAST_POLL_CYCLE_TIMESTAMP.set(time.time())
+        POLL_INTERVAL_SECONDS.set(polling_interval.interval)
+        schedule_next_poll(context.job_queue)
+
+
+async def poll_and_send_messages(context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}|Starting scheduled message.")
     if not Scheduler.is_datetime_in_time_range(datetime.now()):
-        return
+        return 0
 
     processor = context.application.injected_bot_data_processor
-    scraper = context.application.injected_scraper
-
-    username = processor.get_formatted_monitored_username()
-    if not username or not processor.filter_keywords or not processor.subscribed_chat_ids:
+    usernames = processor.get_formatted_monitored_usernames()
+    MONITORED_USERS.set(len(usernames))
+    SUBSCRIBED_CHATS.set(len(processor.subscribed_chat_ids))
+    if not usernames or not processor.keyword_matcher or not processor.subscribed_chat_ids:
         for chat_id in processor.subscribed_chat_ids:
             await send_bot_not_configured(chat_id, context)
         remove_repeating_job(context)
-        return
+        return 0
 
-    await scraper.save_latest_tweets(username)
-    messages_and_urls = await scraper.get_unposed_tweet_messages_and_mark_the_tweets_as_posted(
-        username, processor.filter_keywords)
-
-    for chat_id in processor.subscribed_chat_ids:
-        for message, url in messages_and_urls:
-            logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}|Sending scheduled message: '{message}' to chat '{str(chat_id)}'")
-            await context.bot.send_message(chat_id=chat_id, text=str(message), disable_web_page_preview=True)
-            # await context.bot.send_photo(chat_id, url, caption=message)  # send photo of google search as well
+    scraper_workers = context.application.injected_scraper_workers
+    if scraper_workers:
+        scraper_workers.ensure_running()
+    # Matching and sending run in the pipeline's own tasks, so the next poll doesn't wait for Telegram
+    return await context.application.injected_pipeline.produce(usernames, fetch=scraper_workers is None)
 
 
 async def validate_password_or_send_error_message(password, update, context, chat_id, is_start_stop_sharing_command=False):
@@ -174,9 +260,11 @@ async def validate_password_or_send_error_message(password, update, context, cha
     return True
 
 
-async def validate_args_and_password_for_normal_command(chat_id, update, context, num_required_args=None):
+async def validate_args_and_password_for_normal_command(chat_id, update, context, num_required_args=None,
+                                                       min_required_args=None):
     # Check if password was passed as an argument
-    if not context.args or (len(context.args) != num_required_args if num_required_args else False):
+    if not context.args or (len(context.args) != num_required_args if num_required_args else False) \
+            or (len(context.args) < min_required_args if min_required_args else False):
         await context.bot.send_message(
             chat_id, 'Incorrect data passed. Please use the template for the command shown when you execute /help')
         return
@@ -193,7 +281,8 @@ async def _start_sharing_tweets_on_chat_id(chat_id, update, context):
 
     remove_repeating_job(context)
 
-    if not processor.monitored_twitter_user or not processor.filter_keywords or not processor.subscribed_chat_ids:
+    if not processor.monitored_twitter_users or not processor.get_chat_filter_keywords(chat_id) \
+            or not processor.subscribed_chat_ids:
         await send_bot_not_configured(chat_id, context)
     else:
         start_repeating_job()
@@ -202,7 +291,7 @@ async def _start_sharing_tweets_on_chat_id(chat_id, update, context):
         await context.bot.send_message(
             chat_id=chat_id,
             text='Successfully started bot. '
-                 f'Every minute the latest tweets will be read and you will be notified if it hits your keywords at the scheduled time ({Scheduler.get_available_zone()} UTC)!')
+                 f'The latest tweets will be read regularly (more often while the monitored users are active) and you will be notified if it hits your keywords at the scheduled time ({Scheduler.get_available_zone()} UTC)!')
 
 
 async def start_sharing_tweets(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -316,20 +405,78 @@ async def send_bot_not_configured(chat_id, context):
     return await context.bot.send_message(
         chat_id=chat_id,
         text="""The bot is not yet fully configured. You need to: 
-1. Monitor a user. 
+1. Monitor one or more users. 
 2. Set keywords to match in tweets. 
 3. Start sharing tweets.
 
 Please refer to the commands /help /monitor /set_keywords and /start_sharing""")
 
 
+async def run_database_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    controller = context.application.injected_scraper.controller
+    cutoff = datetime.now() - timedelta(days=DatabaseConstants.RETENTION_DAYS)
+    pruned = await controller.prune_tweets_older_than(cutoff, archive=DatabaseConstants.ARCHIVE_PRUNED_TWEETS)
+    reclaimed_bytes, checkpointed_frames, wal_frames, wal_size = await controller.compact()
+    logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}|Database maintenance "
+                f"{'archived' if DatabaseConstants.ARCHIVE_PRUNED_TWEETS else 'deleted'} {pruned} tweets older than "
+                f"{DatabaseConstants.RETENTION_DAYS} days and reclaimed {reclaimed_bytes} bytes from the database. "
+                f"Checkpointed {checkpointed_frames} of {wal_frames} WAL frames, the WAL is {wal_size} bytes.")
+
+
+async def start_pipeline(application):
+    application.injected_pipeline.start()
+    # In the background, PTB only starts handling the commands once post_init returns and the logins and user
+    # lookups can take a while
+    application.injected_warm_up_task = asyncio.ensure_future(warm_up_scraper(application))
+
+
+async def warm_up_scraper(application):
+    # Logs in the twitter accounts and resolves the monitored users before the first poll
+    if application.injected_scraper_workers:
+        return
+    usernames = application.injected_bot_data_processor.get_formatted_monitored_usernames()
+    try:
+        await application.injected_scraper.initialize(usernames)
+    except Exception as e:
+        logger.error(f"Failed to warm up the scraper, it will be initialized on the first poll: {e}")
+
+
+async def flush_pending_messages(application):
+    # Runs while the bot can still send, the resources are closed after it. The pending digests are sent too.
+    await application.injected_pipeline.stop()
+
+
+async def close_resources(application):
+    if application.injected_warm_up_task:
+        application.injected_warm_up_task.cancel()
+    if application.injected_scraper_workers:
+        application.injected_scraper_workers.stop()
+    await application.injected_scraper.image_resolver.close()
+    application.injected_scraper.controller.close()
+
+
 def remove_repeating_job(context):
-    for job in context.job_queue.jobs():
+    context.application.injected_polling_interval.is_enabled = False
+    if context.application.injected_scraper_workers:
+        context.application.injected_scraper_workers.set_sharing(False)
+    for job in context.job_queue.get_jobs_by_name(BotConstants.AUTOMATIC_POLL_AND_MSG_JOB_NAME):
         job.schedule_removal()
 
 
 def start_repeating_job():
-    job_queue.run_repeating(send_scheduled_message, 45, name=BotConstants.AUTOMATIC_POLL_AND_MSG_JOB_NAME)
+    job_queue.application.injected_polling_interval.is_enabled = True
+    if job_queue.application.injected_scraper_workers:
+        job_queue.application.injected_scraper_workers.set_sharing(True)
+    schedule_next_poll(job_queue)
+
+
+def schedule_next_poll(job_queue):
+    # Each poll schedules the next one when it finishes, so two polls can never overlap
+    polling_interval = job_queue.application.injected_polling_interval
+    if not polling_interval.is_enabled or job_queue.get_jobs_by_name(BotConstants.AUTOMATIC_POLL_AND_MSG_JOB_NAME):
+        return
+    job_queue.run_once(send_scheduled_message, polling_interval.get_next_interval(datetime.now()),
+                       name=BotConstants.AUTOMATIC_POLL_AND_MSG_JOB_NAME)
 
 
 if __name__ == "__main__":
@@ -338,23 +485,42 @@ if __name__ == "__main__":
         os.chdir(sys.argv[1])
 
     logger = setup_logging()
-    bot_data_processor = BotDataProcessor()
-
-    app = Application.builder().token(BotConstants.BOT_TOKEN).build()
+    try:
+        start_metrics_server()
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint: {e}")
+    controller = DatabaseController()
+    bot_data_processor = BotDataProcessor(controller)
+
+    app = Application.builder().token(BotConstants.BOT_TOKEN) \
+        .post_init(start_pipeline).post_stop(flush_pending_messages).post_shutdown(close_resources).build()
     app.injected_bot_data_processor = bot_data_processor
 
-    app.injected_scraper = TwitterScraper()
+    app.injected_scraper = TwitterScraper(controller)
+    app.injected_delivery_engine = DeliveryEngine(app.bot)
+    app.injected_pipeline = TweetPipeline(app.injected_scraper, bot_data_processor, app.injected_delivery_engine)
+    app.injected_polling_interval = AdaptivePollingInterval()
+    app.injected_warm_up_task = None
+    app.injected_scraper_workers = ScraperWorkers(WorkerConstants.SCRAPER_WORKERS) \
+        if WorkerConstants.SCRAPER_WORKERS else None
+    if app.injected_scraper_workers:
+        app.injected_scraper_workers.ensure_running()
 
     job_queue = app.job_queue
     start_repeating_job()
+    job_queue.run_repeating(run_database_maintenance, DatabaseConstants.MAINTENANCE_INTERVAL,
+                            name=BotConstants.DATABASE_MAINTENANCE_JOB_NAME)
 
     app.add_handler(CommandHandler("help", help))
     app.add_handler(CommandHandler("set_keywords", set_keywords))
+    app.add_handler(CommandHandler("set_chat_keywords", set_chat_keywords))
+    app.add_handler(CommandHandler("set_digest", set_digest))
     app.add_handler(CommandHandler("start_sharing", start_sharing_tweets))
     app.add_handler(CommandHandler("stop_sharing", stop_sharing_tweets))
     app.add_handler(CommandHandler("start_sharing_on_channel", start_sharing_tweets_on_channel))
     app.add_handler(CommandHandler("stop_sharing_to_channel", stop_sharing_to_channel))
     app.add_handler(CommandHandler("monitor", monitor))
+    app.add_handler(CommandHandler("status", status))
     app.add_handler(CommandHandler("post_to_channel", post_to_channel))
     logger.info(f"{BotConstants.IMPORTANT_LOG_MARKER}|Starting bot!")
     app.run_polling(poll_interval=3)